@@ -1,10 +1,13 @@
 import logging
 import os
+import shutil
 import yaml
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Tuple
-from src.pipeline import Pipeline, PipelineContext
-from src.manager import DataManager, StateManager
+from types import MappingProxyType
+from typing import List, Optional, Tuple
+from src.pipeline import Pipeline, PipelineContext, StagedPipeline
+from src.manager import DataManager, StateManager, link_or_copy
 from src.downloadStep import DownloadStep
 from src.transcribeStep import TranscribeStep
 from src.notesStep import NotesStep
@@ -19,48 +22,117 @@ logger = logging.getLogger(__name__)
 def load_config() -> dict:
     """Load configuration from config.yaml."""
     with open("config.yaml", "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        # CSafeLoader (libyaml) parses noticeably faster when available
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        return yaml.load(f, Loader=loader)
 
 def clear_temp(data_manager: DataManager, id: int) -> None:
     """Clear data/temp/ for the given id before starting a run."""
     data_manager.clear_temp(id)
 
+def cleanup_after_file(data_manager: DataManager, config: dict, id: int, success: bool) -> None:
+    """Non-interactive per-file temp cleanup for batch runs.
+
+    Clears temp files only when pipeline.auto_cleanup is set, and keeps them
+    for failed files when pipeline.keep_temp_on_failure is set so a retry can
+    resume from the intermediates.
+    """
+    if not config["pipeline"].get("auto_cleanup", False):
+        return
+    if not success and config["pipeline"].get("keep_temp_on_failure", True):
+        return
+    data_manager.clear_temp(id)
+
 def prompt_cleanup(data_manager: DataManager, context: PipelineContext, input_data: str) -> None:
     """Prompt user to delete temp files for a specific id."""
     id = context.metadata["id"]
-    response = input(f"Keep temp files for {input_data} (data/temp/{id:03d}_*)? [y/N]: ").strip().lower()
+    if not data_manager.id_has_temp(id):
+        return  # Nothing to delete; don't bother the user
+    response = input(f"Keep temp files for {input_data} (data/temp/{id:03d}/)? [y/N]: ").strip().lower()
     if response != "y":
         data_manager.clear_temp(id)
-        logger.info(f"Deleted temp files for id {id:03d}")
+        logger.info("Deleted temp files for id %03d", id)
 
 def prompt_batch_cleanup(data_manager: DataManager) -> None:
     """Prompt user to delete all temp files after batch processing, with safety checks and logging."""
     temp_dir = data_manager.temp_dir.resolve()
     assert "temp" in str(temp_dir), f"Refusing to delete non-temp directory: {temp_dir}!"
-    files_to_delete = list(temp_dir.glob("*"))
-    dirs_to_delete = [f for f in files_to_delete if f.is_dir()]
-    files_to_delete = [f for f in files_to_delete if f.is_file()]
-    if not files_to_delete and not dirs_to_delete:
+    entries = sorted(temp_dir.glob("*"))
+    if not entries:
         print(f"No temp files to delete in {temp_dir}.")
         return
     print("The following temp files and directories will be deleted if you confirm:")
-    for d in dirs_to_delete:
-        print(f"  DIR: {d}")
-    for f in files_to_delete:
-        print(f"  FILE: {f}")
+    for entry in entries:
+        print(f"  {'DIR' if entry.is_dir() else 'FILE'}: {entry}")
     response = input(f"Clear all temp files in {temp_dir}? [y/N]: ").strip().lower()
     if response == "y":
-        for d in dirs_to_delete:
-            import shutil
-            shutil.rmtree(d)
-        for f in files_to_delete:
-            f.unlink()
+        # Temp files live in per-id subdirectories, so one rmtree covers the
+        # whole batch instead of unlinking every file individually.
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        temp_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f"Cleared all temp files in {temp_dir}")
 
+def print_image_warnings(metadata: dict) -> None:
+    """Print user-facing warnings about rate-limited or missing images."""
+    if metadata.get("image_rate_limited"):
+        print("\nWARNING: Google Custom Search API rate limit (429) was hit during image search. The generated PDF will contain only image placeholders instead of real images. You may try again later or use a different API key.\n")
+    if (
+        metadata.get("images_total", 0) > 0
+        and metadata.get("images_present", 0) < metadata.get("images_total", 0)
+    ):
+        print(f"\nWARNING: Only {metadata.get('images_present', 0)} out of {metadata.get('images_total', 0)} images were included in the PDF. Some images could not be found and were omitted.\n")
+
+def build_file_pipeline(file: Path, config: dict, state_manager: StateManager) -> Optional[Tuple[PipelineContext, List]]:
+    """Build a PipelineContext and step list for a single input file based on its extension."""
+    ext = file.suffix.lower()
+    input_data = str(file)
+    context = PipelineContext(input_data)
+    context.metadata["id"] = state_manager.get_index(input_data, ext)
+    if ext in {".txt", ".md"}:
+        context.set_result("TranscribeStep", input_data)
+        steps = [NotesStep(), ImageStep(), LatexStep(), PdfStep()]
+        context.metadata["input_type"] = "text_file"
+    elif ext == ".mp3":
+        context.set_result("DownloadStep", input_data)  # Directly set audio file for TranscribeStep
+        steps = [TranscribeStep(), NotesStep(), ImageStep(), LatexStep(), PdfStep()]
+        context.metadata["input_type"] = "video_file"
+    elif ext == ".mp4":
+        # Run DownloadStep to extract audio from video before transcription
+        steps = [DownloadStep(), TranscribeStep(), NotesStep(), ImageStep(), LatexStep(), PdfStep()]
+        context.metadata["input_type"] = "video_file"
+    else:
+        return None
+    return context, steps
+
+def _process_one_file(input_data: str, config: dict, db_path: str) -> Tuple[str, Optional[str], Optional[str], dict]:
+    """Worker for parallel batch processing: run the full pipeline for one file.
+
+    Builds its own StateManager because SQLite connections cannot be shared
+    across processes. Returns (name, pdf_path, error, metadata).
+    """
+    file = Path(input_data)
+    state_manager = StateManager(db_path)
+    try:
+        built = build_file_pipeline(file, config, state_manager)
+        if built is None:
+            return file.name, None, f"Unsupported file type: {file.suffix}", {}
+        context, steps = built
+        pipeline = Pipeline(steps, config=config, state_manager=state_manager)
+        try:
+            context = pipeline.run(input_data, context=context)
+            pdf_path = context.get_result("PdfStep")
+            if pdf_path and os.path.exists(pdf_path):
+                return file.name, pdf_path, None, context.metadata
+            return file.name, None, "No PDF generated", context.metadata
+        except Exception as e:
+            return file.name, None, str(e), context.metadata
+    finally:
+        state_manager.close()
+
 def process_youtube_url(url: str, config: dict, state_manager: StateManager, data_manager: DataManager) -> bool:
     """Process a single YouTube URL."""
-    config["pipeline"]["input_type"] = "youtube_url"
     context = PipelineContext(url)
+    context.metadata["input_type"] = "youtube_url"
     context.metadata["id"] = state_manager.get_index(url, "youtube_url")  # Use global id
     pipeline = Pipeline([
         DownloadStep(),
@@ -73,41 +145,39 @@ def process_youtube_url(url: str, config: dict, state_manager: StateManager, dat
 
     clear_temp(data_manager, context.metadata["id"])  # Clear temp with initialized id
     try:
-        context = pipeline.run(url)
+        context = pipeline.run(url, context=context)
         pdf_path = context.get_result("PdfStep")
-        state_manager.save_success(url, "youtube_url", context.metadata["id"], pdf_path)
-        logger.info(f"Final PDF: {pdf_path}")
-        if context.metadata.get("image_rate_limited"):
-            print("\nWARNING: Google Custom Search API rate limit (429) was hit during image search. The generated PDF will contain only image placeholders instead of real images. You may try again later or use a different API key.\n")
-        if (
-            context.metadata.get("images_total", 0) > 0
-            and context.metadata.get("images_present", 0) < context.metadata.get("images_total", 0)
-        ):
-            print(f"\nWARNING: Only {context.metadata.get('images_present', 0)} out of {context.metadata.get('images_total', 0)} images were included in the PDF. Some images could not be found and were omitted.\n")
+        with state_manager.transaction():
+            state_manager.save_success(url, "youtube_url", context.metadata["id"], pdf_path)
+        logger.info("Final PDF: %s", pdf_path)
+        print_image_warnings(context.metadata)
         prompt_cleanup(data_manager, context, url)
         return True
     except Exception as e:
         logger.error(f"Pipeline failed for {url}: {str(e)}")
-        state_manager.log_error(url, "youtube_url", context.metadata["id"], pipeline.get_failed_step() or "Pipeline", str(e))
-        # Update Init task status to 'failed'
-        state_manager.cursor.execute("""
-            UPDATE tasks SET status = 'failed'
-            WHERE input_data = ? AND input_type = ? AND step_name = 'Init'
-        """, (url, "youtube_url"))
-        state_manager.conn.commit()
+        with state_manager.transaction():
+            state_manager.log_error(url, "youtube_url", context.metadata["id"], pipeline.get_failed_step() or "Pipeline", str(e))
+            # Update Init task status to 'failed'
+            state_manager.cursor.execute("""
+                UPDATE tasks SET status = 'failed'
+                WHERE input_data = ? AND input_type = ? AND step_name = 'Init'
+            """, (url, "youtube_url"))
         prompt_cleanup(data_manager, context, url)
         return False
 
 def process_folder(folder_path: str, input_type: str, config: dict, state_manager: StateManager, data_manager: DataManager) -> None:
     """Process a folder of text or video files."""
-    config["pipeline"]["input_type"] = "text_file" if input_type == "transcript_folder" else "video_file"
+    file_input_type = "text_file" if input_type == "transcript_folder" else "video_file"
     folder = Path(folder_path)
     if not folder.exists():
         logger.error(f"Folder {folder_path} does not exist")
         return
 
-    extensions = [".txt", ".md"] if input_type == "transcript_folder" else [".mp3", ".mp4"]
-    files = sorted([f for f in folder.glob("*") if f.suffix.lower() in extensions])
+    extensions = {".txt", ".md"} if input_type == "transcript_folder" else {".mp3", ".mp4"}
+    # scandir reuses the directory entry's cached type, avoiding a stat per file
+    with os.scandir(folder) as it:
+        files = sorted(Path(e.path) for e in it
+                       if e.is_file(follow_symlinks=False) and os.path.splitext(e.name)[1].lower() in extensions)
     if not files:
         logger.error(f"No {input_type} files found in {folder_path}")
         return
@@ -119,7 +189,8 @@ def process_folder(folder_path: str, input_type: str, config: dict, state_manage
     for file in files:
         input_data = str(file)
         context = PipelineContext(input_data)
-        context.metadata["id"] = state_manager.get_index(input_data, config["pipeline"]["input_type"])
+        context.metadata["id"] = state_manager.get_index(input_data, file_input_type)
+        context.metadata["input_type"] = file_input_type
         # If this is a transcript file, set the transcript path for NotesStep
         if input_type == "transcript_folder":
             context.set_result("TranscribeStep", input_data)
@@ -130,23 +201,18 @@ def process_folder(folder_path: str, input_type: str, config: dict, state_manage
         pipeline = Pipeline(pipeline_steps, config=config, state_manager=state_manager)
 
         try:
-            context = pipeline.run(input_data)
+            context = pipeline.run(input_data, context=context)
             pdf_path = context.get_result("PdfStep")
-            state_manager.save_success(input_data, config["pipeline"]["input_type"], context.metadata["id"], pdf_path)
-            logger.info(f"Final PDF: {pdf_path}")
-            if context.metadata.get("image_rate_limited"):
-                print("\nWARNING: Google Custom Search API rate limit (429) was hit during image search. The generated PDF will contain only image placeholders instead of real images. You may try again later or use a different API key.\n")
-            if (
-                context.metadata.get("images_total", 0) > 0
-                and context.metadata.get("images_present", 0) < context.metadata.get("images_total", 0)
-            ):
-                print(f"\nWARNING: Only {context.metadata.get('images_present', 0)} out of {context.metadata.get('images_total', 0)} images were included in the PDF. Some images could not be found and were omitted.\n")
-            prompt_cleanup(data_manager, context, file.name)
+            with state_manager.transaction():
+                state_manager.save_success(input_data, file_input_type, context.metadata["id"], pdf_path)
+            logger.info("Final PDF: %s", pdf_path)
+            print_image_warnings(context.metadata)
+            cleanup_after_file(data_manager, config, context.metadata["id"], success=True)
         except Exception as e:
             failed_step = pipeline.get_failed_step() or "Unknown"
-            state_manager.log_error(input_data, config["pipeline"]["input_type"], context.metadata["id"], failed_step, str(e))
+            state_manager.log_error(input_data, file_input_type, context.metadata["id"], failed_step, str(e))
             failures.append((context.metadata["id"], input_data, failed_step, str(e)))
-            prompt_cleanup(data_manager, context, file.name)
+            cleanup_after_file(data_manager, config, context.metadata["id"], success=False)
 
     if failures:
         logger.error(f"Pipeline failed for {len(failures)} files:")
@@ -160,6 +226,7 @@ def process_folder(folder_path: str, input_type: str, config: dict, state_manage
             for id, input_data, failed_step, _ in failures:
                 context = PipelineContext(input_data)
                 context.metadata["id"] = id
+                context.metadata["input_type"] = file_input_type
                 # If this is a transcript file, set the transcript path for NotesStep
                 if input_type == "transcript_folder":
                     context.set_result("TranscribeStep", input_data)
@@ -171,25 +238,23 @@ def process_folder(folder_path: str, input_type: str, config: dict, state_manage
                     start_idx = next(i for i, s in enumerate(pipeline_steps) if s.__class__.__name__ == failed_step)
                     pipeline = Pipeline(pipeline_steps[start_idx:], config=config, state_manager=state_manager)
                     if start_idx > 0:
-                        prev_step = pipeline_steps[start_idx - 1]
-                        try:
-                            context.set_result(
-                                prev_step.__class__.__name__,
-                                data_manager.load_temp(context.metadata["id"], 
-                                                    prev_step.__class__.__name__.lower().replace("step", ""),
-                                                    "md" if prev_step.__class__.__name__ in ["NotesStep", "ImageStep"] else "txt")
-                            )
-                        except FileNotFoundError:
-                            logger.warning(f"No temp file for {input_data} at {failed_step}, restarting from beginning")
+                        # Resume from the step that failed using the context
+                        # snapshot written after each completed step.
+                        snapshot = data_manager.load_context(id)
+                        if snapshot:
+                            context.results.update(snapshot["results"])
+                        else:
+                            logger.warning(f"No context snapshot for {input_data} at {failed_step}, restarting from beginning")
                             pipeline = Pipeline(pipeline_steps, config=config, state_manager=state_manager)
-                    context = pipeline.run(input_data)
+                    context = pipeline.run(input_data, context=context)
                     pdf_path = context.get_result("PdfStep")
-                    state_manager.save_success(input_data, config["pipeline"]["input_type"], id, pdf_path)
-                    logger.info(f"Final PDF: {pdf_path}")
-                    prompt_cleanup(data_manager, context, Path(input_data).name)
+                    with state_manager.transaction():
+                        state_manager.save_success(input_data, file_input_type, id, pdf_path)
+                    logger.info("Final PDF: %s", pdf_path)
+                    cleanup_after_file(data_manager, config, id, success=True)
                 except Exception as e:
                     new_failed_step = pipeline.get_failed_step() or "Unknown"
-                    state_manager.log_error(input_data, config["pipeline"]["input_type"], id, new_failed_step, str(e))
+                    state_manager.log_error(input_data, file_input_type, id, new_failed_step, str(e))
                     new_failures.append((id, input_data, new_failed_step, str(e)))
             failures = new_failures
             if failures:
@@ -197,7 +262,8 @@ def process_folder(folder_path: str, input_type: str, config: dict, state_manage
                 for id, input_data, failed_step, error in failures:
                     logger.error(f"- {Path(input_data).name} (id {id:03d}): {failed_step} ({error})")
 
-    prompt_batch_cleanup(data_manager)
+    if not config["pipeline"].get("auto_cleanup", False):
+        prompt_batch_cleanup(data_manager)
 
 def process_mixed_folder(folder_path: str, config: dict, state_manager: StateManager, data_manager: DataManager) -> None:
     """Process a folder of mixed files (.txt, .md, .mp3, .mp4) and save PDFs in data/pdf/."""
@@ -208,57 +274,89 @@ def process_mixed_folder(folder_path: str, config: dict, state_manager: StateMan
         logger.error(f"Folder {folder_path} does not exist")
         return
     supported_exts = {".txt", ".md", ".mp3", ".mp4"}
-    files = sorted([f for f in folder.glob("*") if f.suffix.lower() in supported_exts])
+    # scandir reuses the directory entry's cached type, avoiding a stat per file
+    with os.scandir(folder) as it:
+        files = sorted(Path(e.path) for e in it
+                       if e.is_file(follow_symlinks=False) and os.path.splitext(e.name)[1].lower() in supported_exts)
     if not files:
         logger.error(f"No supported files found in {folder_path}")
         return
     results = []
     failures = []
-    for idx, file in enumerate(files, 1):
-        print(f"###### PROCESSING INPUT {idx}/{len(files)}: {file.name.upper()} ######")
-        print(f"======================================================================")
-        ext = file.suffix.lower()
-        input_data = str(file)
-        context = PipelineContext(input_data)
-        context.metadata["id"] = state_manager.get_index(input_data, ext)
-        # Decide pipeline steps
-        if ext in {".txt", ".md"}:
-            context.set_result("TranscribeStep", input_data)
-            steps = [NotesStep(), ImageStep(), LatexStep(), PdfStep()]
-            config["pipeline"]["input_type"] = "text_file"
-        elif ext == ".mp3":
-            context.set_result("DownloadStep", input_data)  # Directly set audio file for TranscribeStep
-            steps = [TranscribeStep(), NotesStep(), ImageStep(), LatexStep(), PdfStep()]
-            config["pipeline"]["input_type"] = "video_file"
-        elif ext == ".mp4":
-            # Run DownloadStep to extract audio from video before transcription
-            steps = [DownloadStep(), TranscribeStep(), NotesStep(), ImageStep(), LatexStep(), PdfStep()]
-            config["pipeline"]["input_type"] = "video_file"
-        else:
-            logger.warning(f"Skipping unsupported file: {file.name}")
-            continue
-        pipeline = Pipeline(steps, config=config, state_manager=state_manager)
-        try:
-            context = pipeline.run(input_data, context=context)
+    workers = min(config["pipeline"].get("parallel_jobs", 1) or os.cpu_count(), len(files))
+    if workers > 1:
+        # Each file's pipeline is independent and mostly I/O- or subprocess-bound,
+        # so fan the batch out across a process pool. Workers build their own
+        # StateManager (SQLite connections aren't forkable) and temp files are
+        # already namespaced per id, so they don't collide.
+        db_path = config["pipeline"]["db_path"]
+        picklable_config = dict(config)  # MappingProxyType can't cross process boundaries
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_process_one_file, str(f), picklable_config, db_path): f for f in files}
+            for idx, future in enumerate(as_completed(futures), 1):
+                name, pdf_path, error, metadata = future.result()
+                print(f"###### FINISHED INPUT {idx}/{len(files)}: {name.upper()} ######")
+                print(f"======================================================================")
+                if error is None:
+                    results.append((name, pdf_path))
+                    logger.info("Generated PDF for %s: %s", name, pdf_path)
+                else:
+                    failures.append((name, error))
+                    logger.error(f"Pipeline failed for {name}: {error}")
+                print_image_warnings(metadata)
+    elif config["pipeline"].get("batch_mode", "sequential") == "staged":
+        # Overlap stages across files: while file N transcribes, file N+1
+        # downloads. Entries join the shared 6-stage chain at the first step
+        # their extension needs.
+        staged = StagedPipeline(
+            [DownloadStep(), TranscribeStep(), NotesStep(), ImageStep(), LatexStep(), PdfStep()],
+            config=config, state_manager=state_manager,
+            stage_widths=config["pipeline"].get("stage_widths"))
+        submissions = []
+        for file in files:
+            built = build_file_pipeline(file, config, state_manager)
+            if built is None:
+                logger.warning(f"Skipping unsupported file: {file.name}")
+                continue
+            context, steps = built
+            submissions.append((context, steps[0].name))
+        for context in staged.run(submissions):
+            name = Path(context.input_data).name
             pdf_path = context.get_result("PdfStep")
-            if pdf_path and os.path.exists(pdf_path):
-                # Only add to results if PDF is in canonical output dir
-                out_pdf = Path(pdf_path)
-                results.append((file.name, str(out_pdf)))
-                logger.info(f"Generated PDF for {file.name}: {out_pdf}")
+            if not context.metadata.get("failed_step") and pdf_path and os.path.exists(pdf_path):
+                results.append((name, pdf_path))
+                logger.info("Generated PDF for %s: %s", name, pdf_path)
             else:
-                failures.append((file.name, "No PDF generated"))
-                logger.error(f"Failed to generate PDF for {file.name}")
-            if context.metadata.get("image_rate_limited"):
-                print("\nWARNING: Google Custom Search API rate limit (429) was hit during image search. The generated PDF will contain only image placeholders instead of real images. You may try again later or use a different API key.\n")
-            if (
-                context.metadata.get("images_total", 0) > 0
-                and context.metadata.get("images_present", 0) < context.metadata.get("images_total", 0)
-            ):
-                print(f"\nWARNING: Only {context.metadata.get('images_present', 0)} out of {context.metadata.get('images_total', 0)} images were included in the PDF. Some images could not be found and were omitted.\n")
-        except Exception as e:
-            failures.append((file.name, str(e)))
-            logger.error(f"Pipeline failed for {file.name}: {str(e)}")
+                error = str(context.errors[-1][1]) if context.errors else "No PDF generated"
+                failures.append((name, error))
+                logger.error(f"Pipeline failed for {name}: {error}")
+            print_image_warnings(context.metadata)
+    else:
+        for idx, file in enumerate(files, 1):
+            print(f"###### PROCESSING INPUT {idx}/{len(files)}: {file.name.upper()} ######")
+            print(f"======================================================================")
+            input_data = str(file)
+            built = build_file_pipeline(file, config, state_manager)
+            if built is None:
+                logger.warning(f"Skipping unsupported file: {file.name}")
+                continue
+            context, steps = built
+            pipeline = Pipeline(steps, config=config, state_manager=state_manager)
+            try:
+                context = pipeline.run(input_data, context=context)
+                pdf_path = context.get_result("PdfStep")
+                if pdf_path and os.path.exists(pdf_path):
+                    # Only add to results if PDF is in canonical output dir
+                    out_pdf = Path(pdf_path)
+                    results.append((file.name, str(out_pdf)))
+                    logger.info("Generated PDF for %s: %s", file.name, out_pdf)
+                else:
+                    failures.append((file.name, "No PDF generated"))
+                    logger.error(f"Failed to generate PDF for {file.name}")
+                print_image_warnings(context.metadata)
+            except Exception as e:
+                failures.append((file.name, str(e)))
+                logger.error(f"Pipeline failed for {file.name}: {str(e)}")
     # Print summary
     print("\n=== Processing Summary ===")
     for name, pdf in results:
@@ -271,22 +369,11 @@ def process_mixed_folder(folder_path: str, config: dict, state_manager: StateMan
         if response == "y":
             for name, _ in failures:
                 file = folder / name
-                ext = file.suffix.lower()
                 input_data = str(file)
-                context = PipelineContext(input_data)
-                context.metadata["id"] = state_manager.get_index(input_data, ext)
-                if ext in {".txt", ".md"}:
-                    context.set_result("TranscribeStep", input_data)
-                    steps = [NotesStep(), ImageStep(), LatexStep(), PdfStep()]
-                    config["pipeline"]["input_type"] = "text_file"
-                elif ext == ".mp3":
-                    steps = [TranscribeStep(), NotesStep(), ImageStep(), LatexStep(), PdfStep()]
-                    config["pipeline"]["input_type"] = "video_file"
-                elif ext == ".mp4":
-                    steps = [DownloadStep(), TranscribeStep(), NotesStep(), ImageStep(), LatexStep(), PdfStep()]
-                    config["pipeline"]["input_type"] = "video_file"
-                else:
+                built = build_file_pipeline(file, config, state_manager)
+                if built is None:
                     continue
+                context, steps = built
                 pipeline = Pipeline(steps, config=config, state_manager=state_manager)
                 try:
                     context = pipeline.run(input_data, context=context)
@@ -294,19 +381,21 @@ def process_mixed_folder(folder_path: str, config: dict, state_manager: StateMan
                     if pdf_path and os.path.exists(pdf_path):
                         out_pdf = output_dir / (file.stem + ".pdf")
                         if Path(pdf_path).resolve() != out_pdf.resolve():
-                            import shutil
-                            shutil.copy2(pdf_path, out_pdf)
+                            link_or_copy(pdf_path, out_pdf)
                         print(f"RETRY SUCCESS: {name} -> {out_pdf}")
                     else:
                         print(f"RETRY FAILED:  {name} -> No PDF generated")
                 except Exception as e:
                     print(f"RETRY FAILED:  {name} -> {str(e)}")
     print(f"\nAll PDFs are saved in: {output_dir.resolve()}")
-    prompt_batch_cleanup(data_manager)
+    if not config["pipeline"].get("auto_cleanup", False):
+        prompt_batch_cleanup(data_manager)
 
 def main():
     """Main CLI for video-to-pdf conversion."""
-    config = load_config()
+    # Freeze the top level: per-input state travels on PipelineContext
+    # metadata, never by mutating the shared config.
+    config = MappingProxyType(load_config())
     data_manager = DataManager(config)
     state_manager = StateManager(config["pipeline"]["db_path"])
 
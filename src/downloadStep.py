@@ -1,46 +1,106 @@
+import hashlib
 import logging
+import re
+import time
 import yt_dlp
 import os
+from pathlib import Path
 from urllib.parse import urlparse
 import subprocess
 from src.pipeline import ProcessingStep, PipelineContext
-from src.manager import DataManager, StateManager
-from typing import Dict
+from src.manager import DataManager, StateManager, link_or_copy
+from typing import Dict, Optional
 
 logger = logging.getLogger(__name__)
 
+# Matches the 11-char video id in watch?v=, youtu.be, /embed/ and /shorts/
+# URL forms with one precompiled search — no parse_qs dict construction.
+_YT_RE = re.compile(r'(?:v=|youtu\.be/|/embed/|/shorts/)([A-Za-z0-9_-]{11})')
+
+def _download_cache_key(url: str) -> str:
+    """Hash a URL for the download cache, canonicalizing YouTube links.
+
+    All URL forms of the same video collapse to its video id, so a
+    youtu.be share link hits the cache entry a watch?v= run populated.
+    """
+    m = _YT_RE.search(url)
+    return hashlib.sha1((m.group(1) if m else url).encode()).hexdigest()[:16]
+
 def is_url(input_str):
-    try:
-        result = urlparse(input_str)
-        return all([result.scheme, result.netloc])
-    except Exception:
+    # Common schemes short-circuit without allocating a ParseResult;
+    # urlparse only runs for the rare exotic-scheme string.
+    if input_str.startswith(("http://", "https://", "ftp://")):
+        return True
+    if "://" not in input_str:
         return False
+    result = urlparse(input_str)
+    return all([result.scheme, result.netloc])
 
 class DownloadStep(ProcessingStep):
+    def _cached_download(self, url: str, config: Dict, data_manager: DataManager) -> Optional[str]:
+        """Return a cached audio file for this URL, if one is fresh enough."""
+        h = _download_cache_key(url)
+        cache_path = next((data_manager.cache_dir / "yt").glob(f"{h}.*"), None)
+        if cache_path is None:
+            return None
+        ttl = config.get("cache", {}).get("youtube_ttl_seconds")
+        if ttl and time.time() - os.path.getmtime(cache_path) > ttl:
+            logger.info("Cached download for %s expired (older than %ss)", url, ttl)
+            return None
+        return str(cache_path)
+
     def process(self, context: PipelineContext, config: Dict, state_manager: StateManager) -> PipelineContext:
-        data_manager = DataManager(config)
+        data_manager = context.data_manager or DataManager(config)
         id = context.metadata["id"]  # Use global id instead of index
+        input_type = context.metadata.get("input_type") or config["pipeline"].get("input_type")
         input_path = context.input_data
 
-        # Check if video already downloaded
-        output_path = data_manager.temp_dir / f"{id:03d}_video.mp3"
-        if output_path.exists():
-            logger.info(f"Video already downloaded at {output_path}")
-            context.set_result(self.name, str(output_path))
+        # Check if audio already downloaded (any container: mp3/m4a/webm).
+        # Skip yt-dlp's in-progress artifacts — an interrupted run leaves
+        # video.webm.part/.ytdl behind, and a truncated .part file must not
+        # be accepted as the finished audio.
+        existing = next((p for p in data_manager.id_dir(id).glob("video.*")
+                         if p.suffix not in (".part", ".ytdl")), None)
+        if existing is not None:
+            logger.info("Audio already downloaded at %s", existing)
+            context.set_result(self.name, str(existing))
             return context
+        output_path = data_manager.id_dir(id) / "video.mp3"
 
         if os.path.isfile(input_path) and input_path.lower().endswith('.mp4'):
-            # Local file: extract audio using ffmpeg
+            if config.get("transcription", {}).get("stream_local_audio", False):
+                # Don't write an intermediate MP3 at all: TranscribeStep will
+                # pipe ffmpeg's audio output straight into its upload request,
+                # saving one encode pass and a disk write/read cycle.
+                context.metadata["stream_audio_source"] = input_path
+                context.set_result(self.name, input_path)
+                logger.info("Deferring audio extraction for %s to streaming upload", input_path)
+                return context
+            # Local file: extract audio using ffmpeg. Extraction is cached by
+            # content hash (first MiB) so the same clip under a new id — or a
+            # rerun against a fresh database — reuses the existing MP3.
             try:
-                cmd = [
-                    'ffmpeg', '-y', '-i', input_path,
-                    '-vn', '-acodec', 'mp3', str(output_path)
-                ]
-                subprocess.run(cmd, check=True, capture_output=True)
-                logger.info(f"Extracted audio from local video to {output_path}")
+                with open(input_path, "rb") as f:
+                    content_hash = hashlib.sha1(f.read(1 << 20)).hexdigest()[:16]
+                audio_cache = data_manager.cache_dir / "audio" / f"{content_hash}.mp3"
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                if audio_cache.exists():
+                    link_or_copy(audio_cache, output_path)
+                    logger.info("Reused cached audio extraction for %s at %s", input_path, audio_cache)
+                else:
+                    cmd = [
+                        'ffmpeg', '-y', '-loglevel', 'error', '-nostats',
+                        '-i', input_path,
+                        '-vn', '-acodec', 'mp3', '-threads', '0', str(output_path)
+                    ]
+                    # DEVNULL instead of capture_output: no point buffering
+                    # megabytes of ffmpeg progress chatter per file.
+                    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    link_or_copy(output_path, audio_cache)
+                    logger.info("Extracted audio from local video to %s", output_path)
                 state_manager.save_step_output(
                     context.input_data,
-                    config["pipeline"]["input_type"],
+                    input_type,
                     id,
                     self.name,
                     str(output_path)
@@ -51,33 +111,50 @@ class DownloadStep(ProcessingStep):
                 logger.error(f"Failed to extract audio from {input_path}: {str(e)}")
                 raise
         elif is_url(input_path):
+            # Re-runs with a new id would re-pull the same bytes; check the
+            # URL-hash cache first so the download stage drops out entirely.
+            cached = self._cached_download(input_path, config, data_manager)
+            if cached:
+                output_path = data_manager.id_dir(id) / f"video{Path(cached).suffix}"
+                link_or_copy(cached, output_path)
+                logger.info("Reused cached download for %s at %s", input_path, cached)
+                state_manager.save_step_output(
+                    context.input_data,
+                    input_type,
+                    id,
+                    self.name,
+                    str(output_path)
+                )
+                context.set_result(self.name, str(output_path))
+                return context
+
+            # No FFmpegExtractAudio postprocessor: AssemblyAI accepts audio
+            # containers (m4a/webm) directly, so re-encoding to MP3 is a pure
+            # waste of a transcode pass. Upload whatever bestaudio hands us.
+            data_manager.id_dir(id).mkdir(parents=True, exist_ok=True)
             ydl_opts = {
                 'format': 'bestaudio/best',
-                'outtmpl': f"{data_manager.temp_dir}/{id:03d}_%(id)s.%(ext)s",
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
+                'outtmpl': str(data_manager.id_dir(id) / "video.%(ext)s"),
             }
 
             try:
                 with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                     info = ydl.extract_info(context.input_data, download=True)
-                    video_id = info.get('id', 'video')
-                    temp_path = data_manager.temp_dir / f"{id:03d}_{video_id}.mp3"
-                    output_path = data_manager.temp_dir / f"{id:03d}_video.mp3"
-                    os.rename(temp_path, output_path)
+                    output_path = Path(ydl.prepare_filename(info))
+
+                # Populate the URL-hash cache for future runs
+                h = _download_cache_key(input_path)
+                link_or_copy(output_path, data_manager.cache_dir / "yt" / f"{h}{output_path.suffix}")
 
                 state_manager.save_step_output(
                     context.input_data,
-                    config["pipeline"]["input_type"],
+                    input_type,
                     id,
                     self.name,
                     str(output_path)
                 )
                 context.set_result(self.name, str(output_path))
-                logger.info(f"Downloaded video to {output_path}")
+                logger.info("Downloaded video to %s", output_path)
             except Exception as e:
                 logger.error(f"Failed to download {context.input_data}: {str(e)}")
                 raise
@@ -1,29 +1,104 @@
+import hashlib
+import json
 import logging
 import os
+import random
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Dict, List, Tuple, Optional
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 from PIL import Image
-import io
 from dotenv import load_dotenv
 
 from src.pipeline import ProcessingStep, PipelineContext
-from src.manager import DataManager, StateManager
+from src.manager import DataManager, StateManager, link_or_copy
 
 logger = logging.getLogger(__name__)
 load_dotenv()
 
+# Compiled once: the tag syntax is shared by findall and the single-pass sub
+_IMG_TAG = re.compile(r"\[INSERT_IMAGE:\s*'([^']+)'\]")
+
+try:
+    # orjson decodes the multi-KB CSE payloads a few times faster than stdlib
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+class _TokenBucket:
+    """Client-side request pacer: acquire() blocks until a token is free.
+
+    Smooths concurrent search threads to a steady QPS instead of letting
+    them burst straight into Google CSE's rate limit.
+    """
+
+    def __init__(self, rate: float, burst: int = 10):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
 class ImageStep(ProcessingStep):
     """Embeds images in Markdown notes by replacing [INSERT_IMAGE: 'query'] tags."""
 
     rate_limited = False
+    # Shared across instances so Pipeline rebuilds don't reset the pacing
+    _bucket: Optional[_TokenBucket] = None
+    # Shared across instances too: build_file_pipeline constructs a fresh
+    # ImageStep per file, and a per-instance pool would leak its idle worker
+    # threads (never shut down) once per multi-tag file.
+    _executor: Optional[ThreadPoolExecutor] = None
 
     def __init__(self):
         self.api_key, self.cse_id = self._load_api_keys()
         self.search_url = "https://www.googleapis.com/customsearch/v1"
         self.max_attempts = 3
         self.blocked_domains = ["researchgate.net"]
+        # One pooled session for CSE and the image CDNs: keep-alive reuse
+        # skips a TCP+TLS handshake per request, which dominates latency for
+        # these small payloads. Threads share a Session safely.
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=32,
+            max_retries=Retry(total=2, backoff_factor=0.3,
+                              status_forcelist=[500, 502, 503, 504]),
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        if ImageStep._bucket is None:
+            ImageStep._bucket = _TokenBucket(rate=float(os.getenv("CSE_QPS", "1")))
+        # Search and download have different budgets: CSE is QPS-capped while
+        # image CDNs tolerate more, so bound them independently instead of
+        # letting one pool width govern both.
+        self._search_sem = threading.Semaphore(max(1, int(float(os.getenv("CSE_QPS", "1")))))
+        self._dl_sem = threading.Semaphore(8)
+
+    def _get_executor(self, max_workers: int) -> ThreadPoolExecutor:
+        """Lazily create one process-wide pool, reused across files and instances."""
+        if ImageStep._executor is None:
+            ImageStep._executor = ThreadPoolExecutor(max_workers=max_workers)
+        return ImageStep._executor
 
     def _load_api_keys(self) -> Tuple[str, str]:
         """Load Google API key and CSE ID from environment."""
@@ -34,45 +109,113 @@ class ImageStep(ProcessingStep):
             raise ValueError("GOOGLE_API_KEY or GOOGLE_CSE_ID not found")
         return api_key, cse_id
 
-    def _validate_image(self, image_data: bytes, dest_path: Path) -> bool:
-        """Validate image as a JPEG and save if valid."""
+    @staticmethod
+    def _fast_jpeg_ok(path: Path) -> bool:
+        """Cheap SOI/EOI marker check covering the well-formed-JPEG common case."""
         try:
-            image = Image.open(io.BytesIO(image_data))
-            if image.format != "JPEG":
-                logger.warning(f"Image at {dest_path} is not a JPEG (format: {image.format})")
-                return False
-            image.verify()  # Check for corruption
-            dest_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(dest_path, "wb") as f:
-                f.write(image_data)
-            logger.info(f"Validated and saved image to {dest_path}")
+            with open(path, "rb") as f:
+                if f.read(2) != b"\xff\xd8":
+                    return False
+                f.seek(-2, os.SEEK_END)
+                return f.tell() >= 123 and f.read(2) == b"\xff\xd9"
+        except OSError:
+            return False
+
+    def _validate_image(self, path: Path) -> bool:
+        """Validate the file at path as an uncorrupted JPEG."""
+        # CSE results are almost always intact JPEGs; the marker check
+        # accepts those without a full entropy-stream decode. Anything it
+        # rejects goes through PIL to get a precise reason in the log.
+        if self._fast_jpeg_ok(path):
+            return True
+        try:
+            # Opening by path lets PIL read the header lazily instead of
+            # re-parsing an in-memory copy of the whole body
+            with Image.open(path) as image:
+                if image.format != "JPEG":
+                    logger.warning(f"Image at {path} is not a JPEG (format: {image.format})")
+                    return False
+                image.verify()  # Check for corruption
             return True
         except Exception as e:
-            logger.warning(f"Image at {dest_path} is corrupted or invalid: {str(e)}")
+            logger.warning(f"Image at {path} is corrupted or invalid: {str(e)}")
             return False
 
     def _download_image(self, url: str, dest_path: Path) -> bool:
-        """Download image from URL and validate as JPEG."""
+        """Download image from URL, streaming to disk, and validate as JPEG."""
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
         }
+        # Stream into a .part file and publish atomically: peak memory stays
+        # one chunk instead of the whole body, and a failed validation never
+        # leaves a half-written image behind.
+        tmp_path = dest_path.with_suffix(".part")
         try:
-            response = requests.get(url, headers=headers, stream=True, timeout=10)
-            response.raise_for_status()
-            return self._validate_image(response.content, dest_path)
+            with self._dl_sem:
+                response = self._session.get(url, headers=headers, stream=True, timeout=10)
+                response.raise_for_status()
+                tmp_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+            if not self._validate_image(tmp_path):
+                tmp_path.unlink(missing_ok=True)
+                return False
+            os.replace(tmp_path, dest_path)
+            logger.info(f"Validated and saved image to {dest_path}")
+            return True
         except requests.RequestException as e:
             logger.error(f"Failed to download image from {url}: {str(e)}")
+            tmp_path.unlink(missing_ok=True)
             return False
 
-    def _normalize_filename(self, query: str) -> str:
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _normalize_filename(query: str) -> str:
         """Normalize query to a safe, consistent filename for images."""
         # Lowercase, replace spaces and special chars with underscores, remove non-alphanum except underscores and commas
+        # Pure string mangling, so memoized: the same query recurs across
+        # tags, cache lookups and markdown replacement.
         name = query.lower().replace(' ', '_')
         name = re.sub(r'[^a-z0-9_,]', '', name)
         return f"{name}.jpg"
 
+    def _cache_path(self, query: str, data_manager: DataManager) -> Path:
+        """Persistent cache location for a search query's downloaded image.
+
+        Keyed by the normalized query so trivially different spellings
+        ("Fourier Transform" vs "fourier transform") share one cache entry.
+        """
+        h = hashlib.sha1(self._normalize_filename(query).encode()).hexdigest()[:16]
+        return data_manager.cache_dir / "images" / f"{h}.jpg"
+
+    def _resolve_tag(self, query: str, index: int, data_manager: DataManager) -> Tuple[Optional[str], Optional[Path]]:
+        """One fan-out unit: search + download + validate for a single tag.
+
+        Never raises — a broken query yields a placeholder, not a dead batch
+        (the thread-pool equivalent of gather(return_exceptions=True)).
+        """
+        try:
+            return self._search_image(query, index, data_manager)
+        except Exception as e:
+            logger.error(f"Unexpected error resolving image for query '{query}': {str(e)}")
+            return None, None
+
     def _search_image(self, query: str, index: int, data_manager: DataManager) -> Tuple[Optional[str], Optional[Path]]:
         """Search for images and return URL and path of first valid JPEG."""
+        # Reuse a previously downloaded image for the same query; this both
+        # skips the download and keeps us under the CSE rate limit on re-runs.
+        cache_path = self._cache_path(query, data_manager)
+        if cache_path.exists():
+            ttl = data_manager.config.get("cache", {}).get("image_ttl_seconds")
+            if ttl and time.time() - os.path.getmtime(cache_path) > ttl:
+                logger.info(f"Cached image for query '{query}' expired (older than {ttl}s)")
+            else:
+                dest_path = data_manager.image_dir(index) / self._normalize_filename(query)
+                link_or_copy(cache_path, dest_path)
+                logger.info(f"Reused cached image for query: {query}")
+                return f"cache://{cache_path}", dest_path
+
         params = {
             "q": query,
             "cx": self.cse_id,
@@ -82,27 +225,62 @@ class ImageStep(ProcessingStep):
             "imgSize": "large"
         }
         try:
-            response = requests.get(self.search_url, params=params, timeout=10)
+            # Pace requests through the token bucket; on 429, back off
+            # (honouring Retry-After, capped exponentially, with jitter)
+            # and retry instead of burning quota on the remaining queries.
+            for attempt in range(self.max_attempts):
+                ImageStep._bucket.acquire()
+                with self._search_sem:
+                    response = self._session.get(self.search_url, params=params, timeout=10)
+                if response.status_code != 429:
+                    break
+                delay = 2.0 * (2 ** attempt)
+                retry_after = response.headers.get("Retry-After")
+                if retry_after:
+                    try:
+                        delay = min(float(retry_after), delay)
+                    except ValueError:
+                        pass
+                delay += random.uniform(0, 0.5)
+                logger.warning(f"CSE rate limit (429) for query '{query}', backing off {delay:.1f}s "
+                               f"(attempt {attempt + 1}/{self.max_attempts})")
+                time.sleep(delay)
             if response.status_code == 429:
                 # Set a flag in the context (via global variable for now, will propagate to context in process)
                 ImageStep.rate_limited = True
                 logger.error(f"Google Custom Search API rate limit hit (429) for query: {query}")
                 return None, None
             response.raise_for_status()
-            results = response.json()
+            results = _json_loads(response.content)
             if "items" not in results or not results["items"]:
                 logger.warning(f"No images found for query: {query}")
                 return None, None
 
-            image_dir = data_manager.temp_dir / f"{index:03d}_images"
+            image_dir = data_manager.image_dir(index)
             for item in results["items"][:self.max_attempts]:
                 image_url = item["link"]
                 if any(domain in image_url for domain in self.blocked_domains):
                     logger.debug(f"Skipping image from blocked domain: {image_url}")
                     continue
+                # CSE reports the MIME per item; skip non-JPEGs before paying
+                # for the download that validation would reject anyway.
+                mime = item.get("mime", "")
+                if mime and mime != "image/jpeg":
+                    logger.debug(f"Skipping non-JPEG result ({mime}): {image_url}")
+                    continue
+                if not mime:
+                    try:
+                        head = self._session.head(image_url, timeout=5, allow_redirects=True)
+                        ctype = head.headers.get("Content-Type", "")
+                        if ctype and not ctype.startswith("image/jpeg"):
+                            logger.debug(f"Skipping non-JPEG result ({ctype}): {image_url}")
+                            continue
+                    except requests.RequestException:
+                        pass  # HEAD not supported; fall through to the normal GET
                 image_filename = self._normalize_filename(query)
                 dest_path = image_dir / image_filename
                 if self._download_image(image_url, dest_path):
+                    link_or_copy(dest_path, cache_path)
                     return image_url, dest_path
             logger.warning(f"No valid JPEG images found for query: {query}")
             return None, None
@@ -112,10 +290,10 @@ class ImageStep(ProcessingStep):
 
     def process(self, context: PipelineContext, config: Dict, state_manager: StateManager) -> PipelineContext:
         """Process Markdown notes to embed images for [INSERT_IMAGE: 'query'] tags."""
-        data_manager = DataManager(config)
+        data_manager = context.data_manager or DataManager(config)
         notes_md = context.get_result("NotesStep")
         index = context.metadata["id"]
-        pipeline_type = config["pipeline"]["input_type"]
+        pipeline_type = context.metadata.get("input_type") or config["pipeline"].get("input_type")
 
         # Add a class-level flag to track rate limiting
         ImageStep.rate_limited = False
@@ -124,7 +302,9 @@ class ImageStep(ProcessingStep):
             logger.error(f"No notes available in context for {self.name}")
             context.set_result(self.name, None)
             raise ValueError(f"No notes available for {self.name}")
-        if os.path.exists(str(notes_md)):
+        # Only stat values that can plausibly be a path — inline markdown
+        # content should never be handed to the filesystem layer
+        if isinstance(notes_md, (str, Path)) and len(str(notes_md)) < 4096 and os.path.exists(str(notes_md)):
             with open(notes_md, 'r', encoding='utf-8') as f:
                 notes_md = f.read()
         if not notes_md.strip():
@@ -132,69 +312,63 @@ class ImageStep(ProcessingStep):
             context.set_result(self.name, None)
             raise ValueError(f"Notes are empty for {self.name}")
 
+        # Transcripts without image prompts are the common case; a .search
+        # stops at the first hit, so the tagless majority pays one regex scan
+        # and none of the mkdir/stat/save machinery below
+        if not _IMG_TAG.search(notes_md):
+            logger.info(f"No image tags found in notes for {self.name}")
+            context.set_result(self.name, notes_md)
+            return context
+
         # Check for cached output
         existing_output = state_manager.get_step_output(context.input_data, pipeline_type, index, self.name)
-        if existing_output and os.path.exists(existing_output) and not config["pipeline"].get("force_reprocess", False):
+        if existing_output and Path(existing_output).is_file() and not config["pipeline"].get("force_reprocess", False):
             logger.info(f"Skipping {self.name} (output exists at {existing_output})")
             context.set_result(self.name, existing_output)
             return context
 
         try:
-            # Load Markdown notes from context, not temp file
-            notes_md = context.get_result("NotesStep")
-            if not notes_md:
-                logger.error(f"No notes available in context for {self.name}")
-                context.set_result(self.name, None)
-                raise ValueError(f"No notes available for {self.name}")
-            # If notes_md is a file path, read it (for backward compatibility)
-            if os.path.exists(str(notes_md)):
-                with open(notes_md, 'r', encoding='utf-8') as f:
-                    notes_md = f.read()
-            if not notes_md.strip():
-                logger.error(f"Notes are empty for {self.name}")
-                context.set_result(self.name, None)
-                raise ValueError(f"Notes are empty for {self.name}")
-            # Find image tags and process as before
-            image_tags = re.findall(r'\[INSERT_IMAGE:\s*\'([^\']+)\'\]', notes_md)
-            if not image_tags:
-                logger.info(f"No image tags found in notes for {self.name}")
-                context.set_result(self.name, notes_md)
-                # Optionally, save to temp file for caching/debugging
-                output_path = data_manager.save_temp(index, "notes_img", "md", notes_md)
-                state_manager.save_step_output(
-                    input_data=context.input_data,
-                    input_type=pipeline_type,
-                    id=index,
-                    step_name=self.name,
-                    output_path=output_path
-                )
-                return context
-
-            # Process image tags
+            # notes_md was already loaded and validated above; find image tags
+            image_tags = _IMG_TAG.findall(notes_md)
+
+            # Process image tags: each query is an independent search + download,
+            # so fan them out over a small thread pool to overlap the HTTP round
+            # trips. Concurrency is bounded to stay under the CSE QPS limit.
             image_paths: List[str] = []
-            image_dir = data_manager.temp_dir / f"{index:03d}_images"
-            for query in image_tags:
+            image_dir = data_manager.image_dir(index)
+            # The same image is often referenced several times; search each
+            # distinct query once and let the replacement cover every
+            # occurrence (dict.fromkeys keeps first-seen order).
+            unique_tags = list(dict.fromkeys(image_tags))
+            if len(unique_tags) == 1:
+                # One-or-all dispatch: a lone query runs inline, skipping
+                # pool startup/teardown; several queries fan out together.
+                search_results = [self._resolve_tag(unique_tags[0], index, data_manager)]
+            else:
+                # Persistent class-level pool: batch runs rebuild the step
+                # per file, so don't tear worker threads down (or leak them)
+                executor = self._get_executor(config.get("images", {}).get("concurrency", 4))
+                search_results = list(executor.map(
+                    lambda q: self._resolve_tag(q, index, data_manager), unique_tags))
+            resolved: Dict[str, str] = {}
+            for query, (image_url, temp_path) in zip(unique_tags, search_results):
                 filename = self._normalize_filename(query)
                 dest_path = image_dir / filename
-                image_url, temp_path = self._search_image(query, index, data_manager)
                 if ImageStep.rate_limited:
                     context.metadata["image_rate_limited"] = True
                 if not image_url or not temp_path:
                     logger.warning(f"No valid image for query '{query}', adding placeholder")
-                    notes_md = notes_md.replace(
-                        f"[INSERT_IMAGE: '{query}']",
-                        f"<!-- No image found for '{query}' -->"
-                    )
+                    resolved[query] = f"<!-- No image found for '{query}' -->"
                     continue
 
                 # Always use normalized filename for markdown reference
-                relative_path = f"images/{filename}"
-                notes_md = notes_md.replace(
-                    f"[INSERT_IMAGE: '{query}']",
-                    f"![{query}]({relative_path})"
-                )
+                resolved[query] = f"![{query}](images/{filename})"
                 image_paths.append(str(dest_path))
 
+            # Rewrite every tag in one pass over the document instead of a
+            # full str.replace scan per query (O(doc) rather than O(tags*doc))
+            notes_md = _IMG_TAG.sub(lambda m: resolved.get(m.group(1), m.group(0)), notes_md)
+
             # Save updated Markdown to context
             context.set_result(self.name, notes_md)
             # Optionally, save to temp file for caching/debugging
@@ -1,37 +1,198 @@
+import hashlib
 import logging
+import pickle
+import queue
 import sqlite3
 import os
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Optional, Dict, Any
 
+try:  # blake3 SIMD-parallelizes across the buffer (several GB/s vs ~500 MB/s
+    import blake3 as _blake3  # for sha256 without SHA-NI); optional, like orjson
+except ImportError:
+    _blake3 = None
+
 logger = logging.getLogger(__name__)
 
+def content_hash(data: bytes) -> str:
+    """Hex digest for content-addressed cache keys.
+
+    Uses blake3 when installed, falling back to sha256. Cache keys are only
+    compared against keys from the same install, so the algorithms never mix;
+    switching installs just repopulates the caches.
+    """
+    if _blake3 is not None:
+        return _blake3.blake3(data).hexdigest()
+    return hashlib.sha256(data).hexdigest()
+
+_FICLONE = 0x40049409  # linux/fs.h ioctl: clone src extents into dst (reflink)
+
+def link_or_copy(src, dst) -> str:
+    """Publish src at dst without moving bytes where the filesystem allows.
+
+    Tries a reflink (copy-on-write clone on btrfs/XFS), then a hardlink, and
+    only falls back to a byte copy across filesystems (EXDEV) or on other
+    failures.
+    """
+    src, dst = Path(src), Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.exists():
+        dst.unlink()
+    try:
+        import fcntl
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        return str(dst)
+    except (ImportError, OSError):
+        if dst.exists():
+            dst.unlink()  # Remove the empty file left by the failed clone
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return str(dst)
+
 class DataManager:
     """Manages file I/O for pipeline intermediates and outputs."""
     
     def __init__(self, config: Dict[str, Any]):
         self.config = config
         self.temp_dir = Path(config["pipeline"]["temp_dir"])  # data/temp
+        self.cache_dir = Path(config.get("cache", {}).get("dir", "data/cache"))
         self.pdf_dir = Path(config["pipeline"]["pdf_dir"]).resolve()
         self.input_dir = Path(config["pipeline"]["output_dir"]) / "inputs"  # data/inputs
         self.pdf_dir.mkdir(parents=True, exist_ok=True)
         self.input_dir.mkdir(parents=True, exist_ok=True)
+        # Optional deferred writes: a daemon thread drains queued payloads so
+        # step code never blocks on small-file I/O. Off by default; callers
+        # that need the files on disk (e.g. before latexmk) call flush().
+        # Cached temp_dir listing: one scandir answers "does id N have temp
+        # files?" for the whole batch instead of a stat per id per check.
+        self._temp_entries: Optional[set] = None
+        # fsync before publishing each file; off by default since temp
+        # intermediates are rebuildable and the atomic rename alone already
+        # prevents half-written files from being seen as cache hits.
+        self._durable = config["pipeline"].get("durable_writes", False)
+        # Directories already ensured this session: each save then skips the
+        # mkdir stat for parents it has seen before.
+        self._known_dirs = {self.pdf_dir, self.input_dir}
+        self._write_queue: Optional[queue.Queue] = None
+        if config.get("io", {}).get("background_writes", False):
+            self._write_queue = queue.Queue()
+            threading.Thread(target=self._drain_writes, daemon=True).start()
+
+    def _ensure_parent(self, path: Path) -> None:
+        """mkdir the parent only the first time it is seen this session."""
+        parent = path.parent
+        if parent not in self._known_dirs:
+            parent.mkdir(parents=True, exist_ok=True)
+            self._known_dirs.add(parent)
+
+    def _write_file(self, path: Path, data: bytes) -> None:
+        """Write data to a sibling .tmp and rename it into place.
+
+        A crash mid-write leaves only the .tmp behind, never a truncated
+        file at the final path that get_step_output's exists() check would
+        treat as a valid cache hit. 1 MiB buffer: payloads up to that size
+        leave in one syscall, and CPython hands anything larger straight to
+        the raw write anyway.
+        """
+        self._ensure_parent(path)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        try:
+            f = open(tmp, "wb", buffering=1 << 20)
+        except FileNotFoundError:
+            # A known dir was removed behind our back (external cleanup)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            f = open(tmp, "wb", buffering=1 << 20)
+        with f:
+            f.write(data)
+            if self._durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _drain_writes(self) -> None:
+        while True:
+            path, data = self._write_queue.get()
+            try:
+                self._write_file(path, data)
+            except Exception as e:
+                logger.error(f"Background write to {path} failed: {e}")
+            finally:
+                self._write_queue.task_done()
+
+    def _write_bytes(self, path: Path, data: bytes) -> None:
+        """Write data to path, deferring to the background writer if enabled."""
+        self._temp_entries = None
+        if self._write_queue is not None:
+            self._write_queue.put((path, data))
+            return
+        self._write_file(path, data)
+
+    def flush(self) -> None:
+        """Block until all deferred writes have hit disk. No-op if disabled."""
+        if self._write_queue is not None:
+            self._write_queue.join()
+
+    def id_dir(self, id: int) -> Path:
+        """Per-id temp directory data/temp/<id>/ holding all intermediates."""
+        return self.temp_dir / f"{id:03d}"
+
+    def id_has_temp(self, id: int) -> bool:
+        """True if any intermediates exist for this id, using a cached listing."""
+        if self._temp_entries is None:
+            try:
+                with os.scandir(self.temp_dir) as it:
+                    self._temp_entries = {e.name for e in it}
+            except FileNotFoundError:
+                self._temp_entries = set()
+        return f"{id:03d}" in self._temp_entries
+
+    def image_dir(self, id: int) -> Path:
+        """Image directory data/temp/<id>/images/ for a given id."""
+        return self.id_dir(id) / "images"
 
     def save_temp(self, id: int, type: str, ext: str, content: str) -> str:
-        """Save temporary file to data/temp/<id>_<type>.<ext>."""
-        path = self.temp_dir / f"{id:03d}_{type}.{ext}"
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(content)
+        """Save temporary file to data/temp/<id>/<type>.<ext>."""
+        path = self.id_dir(id) / f"{type}.{ext}"
+        # Routed through the deferred-write queue like save_image: with
+        # background_writes on, a burst of intermediates is written by the
+        # drain thread while the pipeline moves on; flush() is the barrier.
+        self._write_bytes(path, content.encode("utf-8"))
+        logger.debug(f"Saved {type} to {path}")
+        return str(path)
+
+    def save_temp_chunks(self, id: int, type: str, ext: str, chunks) -> str:
+        """Stream an iterable of text chunks to data/temp/<id>/<type>.<ext>.
+
+        For producers that yield a document piecewise (e.g. a streamed LLM
+        response), each chunk goes straight into the 1 MiB write buffer
+        without first joining the whole document in memory. Published with
+        the same .tmp + rename pattern as the other saves.
+        """
+        path = self.id_dir(id) / f"{type}.{ext}"
+        self._ensure_parent(path)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp, "wb", buffering=1 << 20) as f:
+            for chunk in chunks:
+                f.write(chunk.encode("utf-8"))
+            if self._durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._temp_entries = None
         logger.debug(f"Saved {type} to {path}")
         return str(path)
 
     def save_image(self, id: int, filename: str, content: bytes) -> str:
-        """Save image to data/temp/<id>_images/<filename>."""
-        path = self.temp_dir / f"{id:03d}_images" / filename
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(content)
+        """Save image to data/temp/<id>/images/<filename>."""
+        path = self.image_dir(id) / filename
+        self._write_bytes(path, content)
         logger.debug(f"Saved image to {path}")
         return str(path)
 
@@ -43,18 +204,27 @@ class DataManager:
     #         f.write(content)
     #     logger.info(f"Saved PDF to {path}")
     #     return str(path)
-    def save_pdf(self, filename: str, content: bytes) -> str:
-        """Save PDF to data/pdfs/<filename>.pdf."""
+    def save_pdf(self, filename: str, content) -> str:
+        """Save PDF to data/pdfs/<filename>.pdf.
+
+        Accepts raw bytes or a Path to an already-written PDF; a path is
+        moved into place with os.replace (atomic, zero-copy on the same
+        filesystem) instead of being read back into memory and rewritten.
+        """
         path = self.pdf_dir / f"{filename}.pdf"
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(content)
+        if isinstance(content, Path):
+            try:
+                os.replace(content, path)
+            except OSError:  # Cross-device move: fall back to a byte copy
+                shutil.copy2(content, path)
+        else:
+            self._write_file(path, content)
         logger.info(f"Saved PDF to {path}")
         return str(path)
 
     def load_temp(self, id: int, type: str, ext: str) -> str:
-        """Load content from data/temp/<id>_<type>.<ext>."""
-        path = self.temp_dir / f"{id:03d}_{type}.{ext}"
+        """Load content from data/temp/<id>/<type>.<ext>."""
+        path = self.id_dir(id) / f"{type}.{ext}"
         if not path.exists():
             logger.error(f"File {path} does not exist")
             raise FileNotFoundError(f"File {path} does not exist")
@@ -63,27 +233,122 @@ class DataManager:
         logger.debug(f"Loaded {type} from {path}")
         return content
 
+    def save_context(self, id: int, context) -> str:
+        """Snapshot a PipelineContext's results/metadata to data/temp/<id>/context.pkl."""
+        path = self.id_dir(id) / "context.pkl"
+        self._write_bytes(path, pickle.dumps({"results": context.results, "metadata": context.metadata}))
+        logger.debug(f"Saved context snapshot to {path}")
+        return str(path)
+
+    def load_context(self, id: int) -> Optional[Dict[str, Any]]:
+        """Load a context snapshot saved by save_context, or None if absent."""
+        path = self.id_dir(id) / "context.pkl"
+        if not path.exists():
+            return None
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
     def clear_temp(self, id: int) -> None:
-        """Delete files in data/temp/ for the given id."""
-        temp_dir = self.temp_dir / f"{id:03d}_images"
-        if temp_dir.exists():
-            import shutil
-            shutil.rmtree(temp_dir)
-        for file in self.temp_dir.glob(f"{id:03d}_*"):
-            file.unlink()
+        """Delete the per-id temp directory in one rmtree."""
+        id_dir = self.id_dir(id)
+        shutil.rmtree(id_dir, ignore_errors=True)
+        self._known_dirs = {d for d in self._known_dirs
+                            if id_dir != d and id_dir not in d.parents}
+        self._temp_entries = None
         logger.info(f"Cleared temp files for id {id:03d}")
         self.temp_dir.mkdir(parents=True, exist_ok=True)
 
 class StateManager:
     """Manages pipeline state in SQLite database."""
-    
+
+    # Statement text assembled once: every execute() with the same string
+    # hits sqlite3's internal statement cache instead of re-parsing SQL.
+    _UPSERT_SUCCESS_SQL = """
+        INSERT OR REPLACE INTO tasks (input_data, input_type, id, step_name, output_path, status)
+        VALUES (?, ?, ?, ?, ?, 'success')
+    """
+    _UPSERT_FAILED_SQL = """
+        INSERT OR REPLACE INTO tasks (input_data, input_type, id, step_name, output_path, status)
+        VALUES (?, ?, ?, ?, NULL, 'failed')
+    """
+    _SELECT_OUTPUT_SQL = """
+        SELECT output_path FROM tasks
+        WHERE input_data = ? AND input_type = ? AND id = ? AND step_name = ? AND status = 'success'
+    """
+    _SELECT_PDF_SQL = """
+        SELECT output_path FROM tasks
+        WHERE input_data = ? AND input_type = ? AND id = ? AND step_name = 'PdfStep' AND status = 'success'
+    """
+
     def __init__(self, db_path: str):
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        self.conn = sqlite3.connect(self.db_path)
+        # check_same_thread=False so staged pipeline workers can share the
+        # connection; the lock below serializes all access to it.
+        # isolation_level=None leaves transaction control to us: single
+        # statements autocommit and transaction() drives explicit
+        # BEGIN IMMEDIATE / COMMIT.
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                    isolation_level=None)
         self.cursor = self.conn.cursor()
+        # WAL lets readers proceed while a writer commits, and NORMAL sync
+        # drops the per-commit journal fsync (WAL stays durable across app
+        # crashes). Commit fsyncs dominate this workload — a pipeline run
+        # writes a row per step per task.
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.cursor.execute("PRAGMA temp_store=MEMORY")
+        self.cursor.execute("PRAGMA cache_size=-20000")  # 20 MB page cache
+        self.cursor.execute("PRAGMA busy_timeout=5000")
+        # Memory-map reads: lookups hit the page cache directly instead of
+        # copying pages through a read() buffer
+        self.cursor.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+        self.lock = threading.RLock()
+        self._in_transaction = False
+        # (input_data, input_type) -> id; ids never change once assigned, so
+        # retries skip the SELECT round-trip entirely.
+        self._index_cache: Dict[tuple, int] = {}
+        # (input_data, input_type, id, step_name) -> output_path LRU. Every
+        # step consults get_step_output before running, so repeat lookups
+        # become a dict hit plus one stat instead of a SQLite round-trip.
+        # Writes invalidate by id because INSERT OR REPLACE on this schema
+        # can displace any row sharing the id.
+        self._lookup_cache: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lookup_cache_size = 512
+        # One persistent append handle for errors.log instead of an
+        # open+write+close triplet per failure; flushed after each write so
+        # the log survives a crash that follows the error.
+        self._err_fp = open(self.db_path.parent / "errors.log", "a",
+                            encoding="utf-8", buffering=1 << 16)
         self._migrate_db()
 
+    @contextmanager
+    def transaction(self):
+        """Batch several writes into a single commit (one fsync instead of N).
+
+        Nested use is safe: only the outermost transaction commits.
+        """
+        with self.lock:
+            if self._in_transaction:
+                yield
+                return
+            self._in_transaction = True
+            try:
+                if not self.conn.in_transaction:
+                    self.conn.execute("BEGIN IMMEDIATE")
+                yield
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                self._in_transaction = False
+
+    def _commit(self) -> None:
+        """Commit unless a transaction() block is batching writes."""
+        if not self._in_transaction:
+            self.conn.commit()
+
     def _migrate_db(self) -> None:
         """Check and migrate tasks table schema."""
         try:
@@ -95,20 +360,27 @@ class StateManager:
                 logger.warning("Tasks table schema outdated or missing. Recreating table.")
                 self.cursor.execute("DROP TABLE IF EXISTS tasks")
                 self._init_db()
-                return
-
-            # Check if the CHECK constraint includes 'pending'
-            self.cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='tasks'")
-            create_table_sql = self.cursor.fetchone()[0]
-            if "CHECK(status IN ('pending', 'success', 'failed'))" not in create_table_sql:
-                logger.warning("Tasks table CHECK constraint outdated. Recreating table.")
-                self.cursor.execute("DROP TABLE IF EXISTS tasks")
-                self._init_db()
             else:
-                logger.debug("Tasks table schema is up-to-date.")
+                # Check if the CHECK constraint includes 'pending'
+                self.cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='tasks'")
+                create_table_sql = self.cursor.fetchone()[0]
+                if "CHECK(status IN ('pending', 'success', 'failed'))" not in create_table_sql:
+                    logger.warning("Tasks table CHECK constraint outdated. Recreating table.")
+                    self.cursor.execute("DROP TABLE IF EXISTS tasks")
+                    self._init_db()
+                else:
+                    logger.debug("Tasks table schema is up-to-date.")
         except sqlite3.OperationalError:
             logger.info("No tasks table found. Creating new table.")
             self._init_db()
+        # Covering index for the four-column lookups in get_step_output /
+        # get_pdf_path; the UNIQUE index lacks id, which forces row fetches.
+        # Also applies to databases created before the index existed.
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_tasks_lookup
+            ON tasks(input_data, input_type, id, step_name, status)
+        """)
+        self.cursor.execute("ANALYZE")
 
     def _init_db(self) -> None:
         """Initialize SQLite database with tasks table for step outputs."""
@@ -126,44 +398,77 @@ class StateManager:
         self.conn.commit()
         logger.info(f"Initialized tasks table in {self.db_path}")
 
+    def _invalidate_lookup(self, id: int) -> None:
+        """Drop cached lookups touching this id (caller holds the lock)."""
+        for key in [k for k in self._lookup_cache if k[2] == id]:
+            del self._lookup_cache[key]
+
     def save_step_output(self, input_data: str, input_type: str, id: int, step_name: str, output_path: str) -> None:
         """Save step output to tasks.db."""
-        self.cursor.execute("""
-            INSERT OR REPLACE INTO tasks (input_data, input_type, id, step_name, output_path, status)
-            VALUES (?, ?, ?, ?, ?, 'success')
-        """, (input_data, input_type, id, step_name, output_path))
-        self.conn.commit()
+        with self.lock:
+            self._invalidate_lookup(id)
+            self.cursor.execute(self._UPSERT_SUCCESS_SQL,
+                                (input_data, input_type, id, step_name, output_path))
+            self._commit()
         logger.debug(f"Saved {step_name} output for {input_data} (id {id:03d}) to {output_path}")
 
+    def save_step_outputs(self, rows) -> None:
+        """Bulk variant of save_step_output for recovery/backfill paths.
+
+        rows are (input_data, input_type, id, step_name, output_path)
+        tuples; executemany inside one transaction means one commit for
+        the whole batch.
+        """
+        with self.transaction():
+            for row in rows:
+                self._invalidate_lookup(row[2])
+            self.cursor.executemany(self._UPSERT_SUCCESS_SQL, rows)
+
     def get_step_output(self, input_data: str, input_type: str, id: int, step_name: str) -> Optional[str]:
         """Get cached output path for a step, if it exists and is valid."""
-        self.cursor.execute("""
-            SELECT output_path FROM tasks
-            WHERE input_data = ? AND input_type = ? AND id = ? AND step_name = ? AND status = 'success'
-        """, (input_data, input_type, id, step_name))
-        result = self.cursor.fetchone()
+        key = (input_data, input_type, id, step_name)
+        with self.lock:
+            path = self._lookup_cache.get(key)
+            if path is not None:
+                self._lookup_cache.move_to_end(key)
+                return path if os.path.exists(path) else None
+            self.cursor.execute(self._SELECT_OUTPUT_SQL, (input_data, input_type, id, step_name))
+            result = self.cursor.fetchone()
+            if result is not None and result[0] is not None:
+                self._lookup_cache[key] = result[0]
+                if len(self._lookup_cache) > self._lookup_cache_size:
+                    self._lookup_cache.popitem(last=False)
         if result is None or result[0] is None:
             return None
         return result[0] if os.path.exists(result[0]) else None
 
     def save_success(self, input_data: str, input_type: str, id: int, pdf_path: str) -> None:
         """Save successful pipeline run (PDF) to tasks.db."""
-        self.save_step_output(input_data, input_type, id, "PdfStep", pdf_path)
-        # Update Init task status to 'success'
-        self.cursor.execute("""
-            UPDATE tasks SET status = 'success'
-            WHERE input_data = ? AND input_type = ? AND step_name = 'Init'
-        """, (input_data, input_type))
-        self.conn.commit()
+        with self.lock:
+            self.save_step_output(input_data, input_type, id, "PdfStep", pdf_path)
+            # Update Init task status to 'success'
+            self.cursor.execute("""
+                UPDATE tasks SET status = 'success'
+                WHERE input_data = ? AND input_type = ? AND step_name = 'Init'
+            """, (input_data, input_type))
+            self._commit()
         logger.info(f"Saved successful pipeline state for {input_data} (id {id:03d})")
 
     def get_pdf_path(self, input_data: str, input_type: str, id: int) -> Optional[str]:
         """Get PDF path for a given input, if it exists."""
-        self.cursor.execute("""
-            SELECT output_path FROM tasks
-            WHERE input_data = ? AND input_type = ? AND id = ? AND step_name = 'PdfStep' AND status = 'success'
-        """, (input_data, input_type, id))
-        result = self.cursor.fetchone()
+        key = (input_data, input_type, id, "PdfStep")
+        with self.lock:
+            path = self._lookup_cache.get(key)
+            if path is not None:
+                self._lookup_cache.move_to_end(key)
+                result = (path,)
+            else:
+                self.cursor.execute(self._SELECT_PDF_SQL, (input_data, input_type, id))
+                result = self.cursor.fetchone()
+                if result is not None and result[0] is not None:
+                    self._lookup_cache[key] = result[0]
+                    if len(self._lookup_cache) > self._lookup_cache_size:
+                        self._lookup_cache.popitem(last=False)
         if result is None or result[0] is None:
             logger.debug(f"No valid PDF path found for {input_data} (id {id:03d})")
             return None
@@ -174,47 +479,73 @@ class StateManager:
 
     def log_error(self, input_data: str, input_type: str, id: int, step_name: str, error: str) -> None:
         """Log error to data/outputs/errors.log and tasks.db."""
-        log_path = self.db_path.parent / "errors.log"
-        with open(log_path, "a", encoding="utf-8") as f:
-            f.write(f"{input_data} (id {id:03d}): {step_name} failed: {error}\n")
+        self._err_fp.write(f"{input_data} (id {id:03d}): {step_name} failed: {error}\n")
+        self._err_fp.flush()
         logger.error(f"{input_data} (id {id:03d}): {step_name} failed: {error}")
-        self.cursor.execute("""
-            INSERT OR REPLACE INTO tasks (input_data, input_type, id, step_name, output_path, status)
-            VALUES (?, ?, ?, ?, NULL, 'failed')
-        """, (input_data, input_type, id, step_name))
-        self.conn.commit()
+        with self.lock:
+            self._invalidate_lookup(id)
+            self.cursor.execute(self._UPSERT_FAILED_SQL, (input_data, input_type, id, step_name))
+            self._commit()
+
+    def log_errors(self, rows) -> None:
+        """Bulk variant of log_error for batch failure handling.
+
+        rows are (input_data, input_type, id, step_name, error) tuples;
+        one executemany and one errors.log append cover the whole batch.
+        """
+        self._err_fp.writelines(
+            f"{input_data} (id {id:03d}): {step_name} failed: {error}\n"
+            for input_data, _input_type, id, step_name, error in rows)
+        self._err_fp.flush()
+        with self.transaction():
+            for row in rows:
+                self._invalidate_lookup(row[2])
+            self.cursor.executemany(self._UPSERT_FAILED_SQL,
+                                    [row[:4] for row in rows])
 
     def get_index(self, input_data: str, input_type: str) -> int:
         """Get the next available id or reuse existing id for the input."""
-        # Check if a task already exists for this input_data and input_type with step_name 'Init'
-        self.cursor.execute("""
-            SELECT id FROM tasks
-            WHERE input_data = ? AND input_type = ? AND step_name = 'Init'
-        """, (input_data, input_type))
-        result = self.cursor.fetchone()
-        
-        if result:
-            id = result[0]
-            # Optionally reset status to 'pending' for retry
+        with self.lock:
+            cached = self._index_cache.get((input_data, input_type))
+            if cached is not None:
+                return cached
+            # Check if a task already exists for this input_data and input_type with step_name 'Init'
             self.cursor.execute("""
-                UPDATE tasks SET status = 'pending'
-                WHERE id = ? AND step_name = 'Init'
-            """, (id,))
-            self.conn.commit()
-            logger.debug(f"Reusing existing ID {id} for {input_data}")
-            return id
-        
-        # Insert new task if no existing task found
-        self.cursor.execute("""
-            INSERT INTO tasks (input_data, input_type, step_name, status)
-            VALUES (?, ?, ?, 'pending')
-        """, (input_data, input_type, "Init"))
-        self.conn.commit()
-        self.cursor.execute("SELECT last_insert_rowid()")
-        id = self.cursor.fetchone()[0]
+                SELECT id FROM tasks
+                WHERE input_data = ? AND input_type = ? AND step_name = 'Init'
+            """, (input_data, input_type))
+            result = self.cursor.fetchone()
+
+            if result:
+                id = result[0]
+                # Optionally reset status to 'pending' for retry
+                self.cursor.execute("""
+                    UPDATE tasks SET status = 'pending'
+                    WHERE id = ? AND step_name = 'Init'
+                """, (id,))
+                self._commit()
+                self._index_cache[(input_data, input_type)] = id
+                logger.debug(f"Reusing existing ID {id} for {input_data}")
+                return id
+
+            # Insert new task if no existing task found
+            self.cursor.execute("""
+                INSERT INTO tasks (input_data, input_type, step_name, status)
+                VALUES (?, ?, ?, 'pending')
+            """, (input_data, input_type, "Init"))
+            self._commit()
+            self.cursor.execute("SELECT last_insert_rowid()")
+            id = self.cursor.fetchone()[0]
+            self._index_cache[(input_data, input_type)] = id
         logger.debug(f"Assigned new ID {id} for {input_data}")
         return id
 
     def close(self) -> None:
         """Close database connection."""
+        self._err_fp.close()
+        try:
+            # Refresh planner statistics so the next run picks good plans
+            self.cursor.execute("PRAGMA optimize")
+        except sqlite3.Error:
+            pass
         self.conn.close()
\ No newline at end of file
@@ -1,20 +1,85 @@
+import json
 import logging
 import os
+import random
 import re
 import time
-from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 from src.pipeline import ProcessingStep, PipelineContext
-from src.manager import DataManager, StateManager
+from src.manager import DataManager, StateManager, content_hash
+from src.imageStep import _TokenBucket
 
 logger = logging.getLogger(__name__)
 load_dotenv()
 
+try:
+    # Same optional fast decoder as imageStep/latexStep; the encoder also
+    # matters here because the payload embeds the whole transcript
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+# Compiled once at import, like the patterns in imageStep/latexStep;
+# MULTILINE is baked in rather than passed per call
+_SECTION_RE = re.compile(r'^##\s+', re.MULTILINE)
+_IMAGE_TAG_RE = re.compile(r"\[INSERT_IMAGE:\s*'[^']+'\]")
+
+# Optional proactive pacing for OpenRouter: with OPENROUTER_RPM set,
+# concurrent process_many workers smooth their calls to just under the
+# account's request limit instead of bursting into 429s and backing off.
+_RPM = os.getenv("OPENROUTER_RPM")
+_PACER = _TokenBucket(rate=float(_RPM) / 60.0, burst=2) if _RPM else None
+
+# Hoisted so the single and batched paths share one byte-identical
+# system prompt (a stable prefix also lets providers prompt-cache it)
+_NOTES_PROMPT = """
+        You are a skilled medical educator and expert academic note-taker specializing in medical lectures.
+
+        You are given a rough transcript from a spoken medical lecture. The transcript may include grammatical errors, repetition, filler words (e.g., "um," "like"), and poor formatting.
+
+        Your job is to convert it into structured, high-quality lecture notes in **Markdown format** suitable for medical students.
+
+        Instructions:
+        1.  **Structure**: Start with a `## Main Title` for the lecture. Organize the rest of the content into logical sections using `###` for sub-headings (e.g., ### Introduction, ### Key Concepts, ### Clinical Applications).
+        2.  **Clean and Summarize**: Clean and rephrase the transcript into concise, grammatically correct sentences. Preserve all medical accuracy and details. Remove filler words, off-topic tangents, and excessive repetition while maintaining the speaker's intent.
+        3.  **Formatting**: Use bullet points or numbered lists for definitions, processes, and key ideas. Highlight key medical terms in bold (e.g., **Glasgow Coma Scale**).
+        4.  **Image Placeholders**: Identify exactly 4 distinct points where a diagram or image would significantly enhance understanding. At these points, insert a placeholder tag in the format `[INSERT_IMAGE: 'A search query for an image']`. Ensure 5 to 8 word search queries that are specific (e.g., 'Anatomical diagram of the brachial plexus' instead of 'nervous system').
+        5.  **Output**: Ensure the final output is valid Markdown with proper syntax and consistent formatting. Avoid deeply nested lists.
+
+        Example output:
+        ```markdown
+        ## Introduction to the Glasgow Coma Scale
+        The **Glasgow Coma Scale (GCS)** is a clinical scale used to reliably measure a person's level of consciousness after a brain injury.
+        - **Purpose**: Standardizes the evaluation of eye-opening, verbal, and motor responses.
+        - **Score Range**: 3 (deep unconsciousness) to 15 (fully conscious).
+
+        [INSERT_IMAGE: 'Chart of the Glasgow Coma Scale components']
+        
+        ### Eye Response (E)
+        * 4 - Spontaneous
+        * 3 - To speech
+        
+        Convert the following transcript into cleaned and structured lecture notes:
+        """
+
 class NotesStep(ProcessingStep):
     """Converts transcripts to structured Markdown lecture notes using OpenRouter's Gemini-2.5-pro."""
 
+    # Shared across instances like ImageStep._bucket: the batch drivers build
+    # a fresh step per file, and a class-level session keeps the warm
+    # OpenRouter connection pool alive across those rebuilds.
+    _shared_session: Optional[requests.Session] = None
+
     def __init__(self):
         self.api_key = self._load_api_key()
         self.api_url = "https://openrouter.ai/api/v1/chat/completions"
@@ -22,6 +87,14 @@ class NotesStep(ProcessingStep):
         self.max_retries = 2
         self.max_tokens = 15000
         self.temperature = 0.7
+        # Keep-alive session as in LatexStep: retries and subsequent tasks
+        # reuse one TCP+TLS connection instead of paying the handshake each
+        # call. Retries stay with the step's own loop.
+        if NotesStep._shared_session is None:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(max_retries=0, pool_connections=4, pool_maxsize=8))
+            NotesStep._shared_session = session
+        self.session = NotesStep._shared_session
 
     def _load_api_key(self) -> str:
         """Load OpenRouter API key from environment."""
@@ -34,16 +107,28 @@ class NotesStep(ProcessingStep):
     def _validate_markdown(self, notes: str) -> bool:
         """Validate Markdown structure: at least 2 sections and 3-6 image tags."""
         try:
-            # Check for at least two '##' style headers
-            sections = len(re.findall(r'^##\s+', notes, re.MULTILINE))
+            # Check for at least two '##' style headers. finditer counts
+            # without materializing a match list, and the scan stops as soon
+            # as the threshold is settled.
+            sections = 0
+            for _ in _SECTION_RE.finditer(notes):
+                sections += 1
+                if sections >= 2:
+                    break
             if sections < 2:
                 logger.warning(f"Markdown validation failed: Found {sections} sections, expected at least 2.")
                 return False
 
-            # Check for the number of image insertion tags
-            image_tags = len(re.findall(r'\[INSERT_IMAGE:\s*\'[^\']+\'\]', notes))
+            # Check for the number of image insertion tags; past 6 the exact
+            # count no longer matters
+            image_tags = 0
+            for _ in _IMAGE_TAG_RE.finditer(notes):
+                image_tags += 1
+                if image_tags > 6:
+                    break
             if not 3 <= image_tags <= 6:
-                logger.warning(f"Markdown validation failed: Found {image_tags} image tags, expected between 3 and 6.")
+                found = "more than 6" if image_tags > 6 else image_tags
+                logger.warning(f"Markdown validation failed: Found {found} image tags, expected between 3 and 6.")
                 return False
 
             logger.info("Markdown validation successful.")
@@ -52,37 +137,69 @@ class NotesStep(ProcessingStep):
             logger.error(f"An error occurred during Markdown validation: {str(e)}")
             return False
 
-    def _generate_notes(self, transcript: str) -> str:
-        """Generate lecture notes from transcript using OpenRouter API."""
-        prompt = """
-        You are a skilled medical educator and expert academic note-taker specializing in medical lectures.
+    def _estimate_max_tokens(self, transcript: str) -> int:
+        """Size the completion budget to the transcript instead of a flat cap.
 
-        You are given a rough transcript from a spoken medical lecture. The transcript may include grammatical errors, repetition, filler words (e.g., "um," "like"), and poor formatting.
+        Notes run ~50-60% of the transcript length at ~4 chars per token;
+        the headroom covers headings and image tags and the floor protects
+        short transcripts. Providers count the requested budget against TPM
+        and queueing, so a tight cap lets more calls run concurrently.
+        """
+        return max(1024, min(self.max_tokens, int(len(transcript) / 4 * 0.6) + 512))
 
-        Your job is to convert it into structured, high-quality lecture notes in **Markdown format** suitable for medical students.
+    def _system_message(self, prompt: str) -> Dict:
+        """Build the system message, marked cacheable where the provider allows.
 
-        Instructions:
-        1.  **Structure**: Start with a `## Main Title` for the lecture. Organize the rest of the content into logical sections using `###` for sub-headings (e.g., ### Introduction, ### Key Concepts, ### Clinical Applications).
-        2.  **Clean and Summarize**: Clean and rephrase the transcript into concise, grammatically correct sentences. Preserve all medical accuracy and details. Remove filler words, off-topic tangents, and excessive repetition while maintaining the speaker's intent.
-        3.  **Formatting**: Use bullet points or numbered lists for definitions, processes, and key ideas. Highlight key medical terms in bold (e.g., **Glasgow Coma Scale**).
-        4.  **Image Placeholders**: Identify exactly 4 distinct points where a diagram or image would significantly enhance understanding. At these points, insert a placeholder tag in the format `[INSERT_IMAGE: 'A search query for an image']`. Ensure 5 to 8 word search queries that are specific (e.g., 'Anatomical diagram of the brachial plexus' instead of 'nervous system').
-        5.  **Output**: Ensure the final output is valid Markdown with proper syntax and consistent formatting. Avoid deeply nested lists.
+        Anthropic-routed models need an explicit cache_control block to skip
+        re-prefilling the static prompt (cached prefix tokens bill at a
+        fraction of the normal rate); OpenAI-style providers prefix-cache
+        automatically as long as the stable system text leads the request,
+        which it does.
+        """
+        if self.model.startswith("anthropic/"):
+            return {"role": "system",
+                    "content": [{"type": "text", "text": prompt,
+                                 "cache_control": {"type": "ephemeral"}}]}
+        return {"role": "system", "content": prompt}
 
-        Example output:
-        ```markdown
-        ## Introduction to the Glasgow Coma Scale
-        The **Glasgow Coma Scale (GCS)** is a clinical scale used to reliably measure a person's level of consciousness after a brain injury.
-        - **Purpose**: Standardizes the evaluation of eye-opening, verbal, and motor responses.
-        - **Score Range**: 3 (deep unconsciousness) to 15 (fully conscious).
+    def _stream_completion(self, headers: Dict, payload: Dict) -> tuple:
+        """POST the chat request with streaming and accumulate delta content.
 
-        [INSERT_IMAGE: 'Chart of the Glasgow Coma Scale components']
-        
-        ### Eye Response (E)
-        * 4 - Spontaneous
-        * 3 - To speech
-        
-        Convert the following transcript into cleaned and structured lecture notes:
+        Chunks are consumed as they arrive instead of waiting for the full
+        completion to be buffered and parsed in one shot. Returns
+        (content, usage); usage comes from the final frame when the
+        provider includes it.
         """
+        payload = dict(payload, stream=True)
+        parts = []
+        usage = {}
+        # Serialize once ourselves (headers already declare application/json)
+        # instead of letting requests re-encode the transcript with stdlib json
+        with self.session.post(self.api_url, headers=headers, data=_json_dumps(payload),
+                               timeout=60, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                data = line[6:]
+                if data == "[DONE]":
+                    break
+                try:
+                    frame = _json_loads(data)
+                except ValueError:
+                    continue
+                usage = frame.get("usage") or usage
+                try:
+                    delta = frame["choices"][0]["delta"].get("content") or ""
+                except (KeyError, IndexError):
+                    continue
+                if delta:
+                    parts.append(delta)
+        return "".join(parts), usage
+
+    def _generate_notes(self, transcript: str) -> str:
+        """Generate lecture notes from transcript using OpenRouter API."""
+        prompt = _NOTES_PROMPT
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -90,30 +207,44 @@ class NotesStep(ProcessingStep):
         payload = {
             "model": self.model,
             "messages": [
-                {"role": "system", "content": prompt},
+                self._system_message(prompt),
                 {"role": "user", "content": transcript}
             ],
-            "max_tokens": self.max_tokens,
+            "max_tokens": self._estimate_max_tokens(transcript),
             "temperature": self.temperature
         }
 
         for attempt in range(self.max_retries):
             try:
-                response = requests.post(self.api_url, headers=headers, json=payload, timeout=60)
-                response.raise_for_status()
-                notes = response.json()["choices"][0]["message"]["content"]
-                token_usage = response.json().get('usage', {}).get('total_tokens', 'unknown')
-                logger.info(f"Generated notes with {self.model}, used {token_usage} tokens")
+                if _PACER is not None:
+                    _PACER.acquire()
+                notes, usage = self._stream_completion(headers, payload)
+                token_usage = usage.get('total_tokens', 'unknown')
+                logger.info("Generated notes with %s, used %s tokens", self.model, token_usage)
                 return notes
             except requests.exceptions.HTTPError as e:
-                status_code = e.response.status_code if e.response else "unknown"
+                status_code = e.response.status_code if e.response is not None else "unknown"
                 logger.error(f"Attempt {attempt+1}/{self.max_retries} failed: HTTP {status_code} - {str(e)}")
                 if status_code in (429, 500, 503) and attempt < self.max_retries - 1:
-                    wait = 2 ** (attempt + 1) * 5
-                    logger.info(f"Retrying after {wait} seconds...")
+                    # Honor the server's Retry-After when given; otherwise a
+                    # capped exponential plus jitter so concurrent workers
+                    # don't reconverge on the same instant
+                    retry_after = e.response.headers.get("Retry-After") if e.response is not None else None
+                    if retry_after and retry_after.isdigit():
+                        wait = min(60, int(retry_after))
+                    else:
+                        wait = min(60, 2 ** attempt * 5) + random.uniform(0, 5)
+                    logger.info("Retrying after %.1f seconds...", wait)
                     time.sleep(wait)
                     continue
                 raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # Transient network failures are as retryable as a 503
+                logger.error(f"Attempt {attempt+1}/{self.max_retries} failed: {str(e)}")
+                if attempt < self.max_retries - 1:
+                    time.sleep(min(60, 2 ** attempt * 5) + random.uniform(0, 5))
+                    continue
+                raise
             except Exception as e:
                 logger.error(f"Attempt {attempt+1}/{self.max_retries} failed with an unexpected error: {str(e)}")
                 if attempt < self.max_retries - 1:
@@ -122,9 +253,73 @@ class NotesStep(ProcessingStep):
                     raise RuntimeError("Failed to generate notes after all retries") from e
         return "" # Should not be reached, but satisfies linters
 
+    def _generate_notes_multi(self, transcripts: list) -> list:
+        """Generate notes for several transcripts in one OpenRouter call.
+
+        Row-marshals the transcripts with === TRANSCRIPT n === fences so the
+        instruction prompt is sent (and billed) once per batch instead of
+        once per transcript, and one request covers K transcripts under the
+        same RPM budget. Sections whose returned notes fail validation fall
+        back to individual _generate_notes calls. Mirrors LatexStep's batch
+        helper.
+        """
+        marshalled = "\n".join(
+            f"=== TRANSCRIPT {i} ===\n{t}" for i, t in enumerate(transcripts))
+        batch_instructions = (
+            "\nYou will receive several transcripts, delimited by lines of "
+            "the form === TRANSCRIPT n ===. Convert each one independently "
+            "using the rules above and emit the results delimited the same "
+            "way: a line === NOTES n === followed by that transcript's "
+            "complete Markdown notes, in the same order."
+        )
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        payload = {
+            "model": self.model,
+            "messages": [
+                self._system_message(_NOTES_PROMPT + batch_instructions),
+                {"role": "user", "content": marshalled}
+            ],
+            "max_tokens": self.max_tokens * len(transcripts),
+            "temperature": self.temperature
+        }
+        results = [None] * len(transcripts)
+        try:
+            if _PACER is not None:
+                _PACER.acquire()
+            response = self.session.post(self.api_url, headers=headers,
+                                         data=_json_dumps(payload), timeout=120)
+            response.raise_for_status()
+            raw = _json_loads(response.content)["choices"][0]["message"]["content"]
+            chunks = re.split(r"===\s*NOTES\s*\d+\s*===", raw)[1:]
+            for pos, chunk in enumerate(chunks[:len(transcripts)]):
+                chunk = chunk.strip()
+                if chunk and self._validate_markdown(chunk):
+                    results[pos] = chunk
+        except requests.RequestException as e:
+            logger.error(f"Batched notes generation failed, falling back per transcript: {e}")
+        for pos, transcript in enumerate(transcripts):
+            if results[pos] is None:
+                results[pos] = self._generate_notes(transcript)
+        return results
+
+    def process_many(self, contexts: list, config: Dict[str, Any], state_manager: StateManager) -> list:
+        """Run process() for several contexts concurrently.
+
+        The step spends its time waiting on OpenRouter, so overlapping the
+        calls takes N tasks from N*t to roughly t. Capped at 8 in-flight
+        requests to stay within provider rate limits; the session pool above
+        is sized to match.
+        """
+        with ThreadPoolExecutor(max_workers=min(8, len(contexts))) as executor:
+            return list(executor.map(
+                lambda ctx: self.process(ctx, config, state_manager), contexts))
+
     def process(self, context: PipelineContext, config: Dict[str, Any], state_manager: StateManager) -> PipelineContext:
         """Process transcript into Markdown lecture notes."""
-        input_type = config["pipeline"]["input_type"]
+        input_type = context.metadata.get("input_type") or config["pipeline"].get("input_type")
         
         # FIX: Consistently use 'id' from context metadata
         id = context.metadata.get("id")
@@ -145,22 +340,43 @@ class NotesStep(ProcessingStep):
                 logger.error(f"No transcript available in context for {self.name}")
                 context.set_result(self.name, None)
                 raise ValueError("No transcript available for NotesStep")
-            # If transcript is a file path, read it (for backward compatibility)
-            if os.path.exists(str(transcript)):
+            # If transcript is a file path, read it (for backward compatibility).
+            # Only stat plausible paths, never whole in-memory transcripts.
+            if isinstance(transcript, (str, os.PathLike)) and len(str(transcript)) < 4096 and os.path.exists(str(transcript)):
                 with open(transcript, 'r', encoding='utf-8') as f:
                     transcript = f.read()
             if not transcript.strip():
                 logger.error(f"Transcript is empty for {self.name}")
                 context.set_result(self.name, None)
                 raise ValueError("Transcript is empty for NotesStep")
-            # Generate and validate notes
-            notes = self._generate_notes(transcript)
-            if not self._validate_markdown(notes):
-                logger.warning("Generated notes failed validation but will be saved for review.")
+            data_manager = context.data_manager or DataManager(config)
+            # Content-hash cache: the same transcript under the same model
+            # always yields reusable notes, so repeat runs (toggled
+            # force_reprocess, identical captions across ids) skip the paid
+            # LLM call. Same layout as the latex cache. The key hashes a
+            # case-folded, whitespace-collapsed transcript so captions that
+            # differ only in formatting still hit.
+            notes_cache = data_manager.cache_dir / "notes"
+            normalized = " ".join(transcript.lower().split())
+            cache_key = content_hash((self.model + normalized).encode("utf-8"))
+            cache_path = notes_cache / f"{cache_key}.md"
+            if cache_path.exists() and not config["pipeline"].get("force_reprocess", False):
+                logger.info("Using cached notes %s", cache_path.name)
+                notes = cache_path.read_text(encoding="utf-8")
+            else:
+                # Generate and validate notes. Only validated notes enter the
+                # cache — a hit skips validation, so caching a bad generation
+                # would pin it for every future id with this transcript. The
+                # save_temp copy below still keeps failures around for review.
+                notes = self._generate_notes(transcript)
+                if self._validate_markdown(notes):
+                    notes_cache.mkdir(parents=True, exist_ok=True)
+                    cache_path.write_text(notes, encoding="utf-8")
+                else:
+                    logger.warning("Generated notes failed validation but will be saved for review.")
             # Save notes to context
             context.set_result(self.name, notes)
             # Optionally, save to temp file for caching/debugging
-            data_manager = DataManager(config)
             output_path = data_manager.save_temp(id, "notes", "md", notes)
             state_manager.save_step_output(
                 input_data=context.input_data,
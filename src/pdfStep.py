@@ -2,60 +2,104 @@ import logging
 import os
 import subprocess
 import time
-from typing import Dict
+from typing import Dict, Optional
 from pathlib import Path
 
 from src.pipeline import ProcessingStep, PipelineContext
-from src.manager import DataManager, StateManager
+from src.manager import DataManager, StateManager, content_hash, link_or_copy
 
 logger = logging.getLogger(__name__)
 
 class PdfStep(ProcessingStep):
     """Compiles LaTeX notes to PDF using latexmk with pdflatex."""
 
+    # Cached `pdflatex --version` banner, probed once per process; folded into
+    # the PDF cache key so a TeX upgrade invalidates stale compiles.
+    _version_tag: Optional[bytes] = None
+    # Cached distribution probe; the toolchain does not change mid-batch, so
+    # two subprocess forks per input would be pure overhead.
+    _latex_ok: Optional[bool] = None
+
     def __init__(self):
         self.max_retries = 3
 
+    def _pdflatex_version_tag(self) -> bytes:
+        if PdfStep._version_tag is None:
+            try:
+                PdfStep._version_tag = subprocess.check_output(
+                    ["pdflatex", "--version"], stderr=subprocess.DEVNULL
+                )[:40]
+            except (subprocess.CalledProcessError, FileNotFoundError, OSError):
+                PdfStep._version_tag = b""
+        return PdfStep._version_tag
+
     def _check_latex_distribution(self) -> bool:
-        """Check if pdflatex and latexmk are available."""
-        try:
-            subprocess.run(["pdflatex", "--version"], check=True, capture_output=True, text=True)
-            subprocess.run(["latexmk", "--version"], check=True, capture_output=True, text=True)
-            return True
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            logger.error("pdflatex or latexmk not found. Install BasicTeX with: brew install basictex")
-            return False
+        """Check if pdflatex and latexmk are available (probed once per process)."""
+        if PdfStep._latex_ok is None:
+            try:
+                subprocess.run(["pdflatex", "--version"], check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                subprocess.run(["latexmk", "--version"], check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                PdfStep._latex_ok = True
+            except (subprocess.CalledProcessError, FileNotFoundError):
+                logger.error("pdflatex or latexmk not found. Install BasicTeX with: brew install basictex")
+                PdfStep._latex_ok = False
+        return PdfStep._latex_ok
+
+    def _compile_latex(self, tex_path: str, output_dir: Path, pdf_path: Path, build_dir: Path) -> Path:
+        """Compile LaTeX file to PDF using latexmk with retries.
 
-    def _compile_latex(self, tex_path: str, output_dir: Path, pdf_path: Path) -> bytes:
-        """Compile LaTeX file to PDF using latexmk with retries."""
+        Aux files (.aux/.fls/.toc) live in a persistent per-document build_dir
+        instead of being wiped with `latexmk -c` after every run, so latexmk's
+        own incrementality can skip pdflatex passes on recompiles.
+        """
         tex_dir = Path(tex_path).resolve().parent  # Resolve to absolute path
         logger.info(f"Compiling from resolved tex_dir: {tex_dir}")
+        aux_dir = build_dir / "aux"
+        out_dir = build_dir / "out"
+        aux_dir.mkdir(parents=True, exist_ok=True)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        output_dir.mkdir(parents=True, exist_ok=True)
         actual_pdf_name = f"{Path(tex_path).stem}.pdf"  # e.g., 002_latex.pdf
-        actual_pdf_path = tex_dir / actual_pdf_name
+        actual_pdf_path = out_dir / actual_pdf_name
+        # latexmk chatter goes straight to a file: no point accumulating tens
+        # of thousands of lines as Python strings when it is only read on
+        # failure.
+        latexmk_log = build_dir / f"{Path(tex_path).stem}.latexmk.out"
+
+        # Everything below is invariant across retry attempts: check the
+        # input and build the command once, not per attempt.
+        if not os.path.exists(tex_path):
+            logger.error(f"TeX file not found at {tex_path} before compilation")
+            raise FileNotFoundError(f"TeX file not found at {tex_path}")
+        # Generated notes have no \ref/\cite chains to converge, but hyperref
+        # plus the figure \labels always rewrite the .aux on the first pass,
+        # so latexmk needs exactly one rerun — cap it at two passes (not
+        # latexmk's default five) and skip synctex output and rc files.
+        latexmk_cmd = [
+            "latexmk",
+            "-pdf",
+            "-pdflatex=pdflatex -synctex=0 %O %S",
+            "-interaction=nonstopmode",
+            "-norc",
+            "-e", "$max_repeat=2;",
+            "-recorder",
+            f"-auxdir={aux_dir}",
+            f"-outdir={out_dir}",
+            Path(tex_path).name
+        ]
 
         for attempt in range(1, self.max_retries + 1):
             try:
-                if not os.path.exists(tex_path):
-                    logger.error(f"TeX file not found at {tex_path} before compilation")
-                    raise FileNotFoundError(f"TeX file not found at {tex_path}")
-                
-                text_filename = Path(tex_path).name
-                latexmk_cmd = [
-                    "latexmk",
-                    "-pdf",
-                    "-pdflatex=pdflatex",
-                    "-interaction=nonstopmode",
-                    f"-outdir={tex_dir}",
-                    text_filename
-                ]
                 logger.info(f"Running latexmk with cmd: {latexmk_cmd}")
-                result = subprocess.run(latexmk_cmd, check=True, capture_output=True, text=True, cwd=tex_dir)
-                logger.info(f"Ran latexmk for {tex_path}")
-                logger.debug(f"latexmk stdout: {result.stdout}")
+                with open(latexmk_log, "wb") as log_fp:
+                    subprocess.run(latexmk_cmd, check=True, stdout=log_fp, stderr=subprocess.STDOUT, cwd=tex_dir)
+                logger.info(f"Ran latexmk for {tex_path} (output in {latexmk_log})")
 
                 if not actual_pdf_path.exists():
                     logger.error(f"PDF {actual_pdf_path} was not created")
-                    log_path = tex_dir / f"{Path(tex_path).stem}.log"
+                    log_path = aux_dir / f"{Path(tex_path).stem}.log"
                     if log_path.exists():
                         with open(log_path, "r", encoding="utf-8") as f:
                             log_content = f.read()
@@ -64,24 +108,20 @@ class PdfStep(ProcessingStep):
                                 logger.warning("Table or content may be too wide. Adjust table widths or margins.")
                     raise FileNotFoundError(f"PDF {actual_pdf_path} was not created")
 
-                with open(actual_pdf_path, "rb") as f:
-                    pdf_content = f.read()
-
-                output_dir.mkdir(parents=True, exist_ok=True)
-                os.rename(actual_pdf_path, pdf_path)
+                # os.replace is atomic and overwrites a stale PDF from an
+                # earlier run; it either succeeds or raises, so no post-check.
+                os.replace(actual_pdf_path, pdf_path)
                 logger.info(f"Renamed {actual_pdf_path} to {pdf_path}")
+                return pdf_path
 
-                clean_cmd = ["latexmk", "-c", f"-outdir={tex_dir}", text_filename]
-                subprocess.run(clean_cmd, check=True, capture_output=True, text=True, cwd=tex_dir)
-                logger.info(f"Cleaned auxiliary files for {tex_path}")
-
-                if not pdf_path.exists():
-                    logger.error(f"Renamed PDF {pdf_path} does not exist after renaming")
-                    raise FileNotFoundError(f"Renamed PDF {pdf_path} does not exist")
-                return pdf_content
-
-            except subprocess.CalledProcessError as e:
-                logger.error(f"Attempt {attempt} failed: latexmk error: {e.stderr}")
+            except subprocess.CalledProcessError:
+                tail = b""
+                try:
+                    tail = latexmk_log.read_bytes()[-4096:]
+                except OSError:
+                    pass
+                logger.error(f"Attempt {attempt} failed: latexmk error (full output in {latexmk_log}):\n"
+                             f"{tail.decode('utf-8', 'replace')}")
                 if attempt < self.max_retries:
                     logger.info(f"Retrying compilation (attempt {attempt + 1}/{self.max_retries})")
                     time.sleep(2)
@@ -103,28 +143,60 @@ class PdfStep(ProcessingStep):
             logger.error(f"No LaTeX content available in context for {self.name}")
             context.set_result(self.name, None)
             raise ValueError(f"No LaTeX content available for {self.name}")
-        # If latex_content is a file path, read it (for backward compatibility)
-        if os.path.exists(str(latex_content)):
+        # A skipped LatexStep resumes with its output path as the result, so
+        # a path must still be readable here — but only strings that can
+        # plausibly be one (short, single line) pay the stat; real LaTeX
+        # source never does, sparing a syscall and the misread hazard of
+        # content that happens to start with an existing path.
+        latex_content = str(latex_content)
+        if len(latex_content) < 4096 and "\n" not in latex_content and os.path.exists(latex_content):
             with open(latex_content, 'r', encoding='utf-8') as f:
                 latex_content = f.read()
         if not latex_content.strip():
             logger.error(f"LaTeX content is empty for {self.name}")
             context.set_result(self.name, None)
             raise ValueError(f"LaTeX content is empty for {self.name}")
+        data_manager = context.data_manager or DataManager(config)
+        input_stem = Path(context.input_data).stem
+        # Identical LaTeX compiled by the same pdflatex yields an identical
+        # PDF, and latexmk dominates the pipeline's wall clock — so reuse the
+        # cached output instead of recompiling.
+        cache_key = content_hash(
+            self._pdflatex_version_tag() + latex_content.encode("utf-8")
+        )
+        cache_path = data_manager.cache_dir / "pdf" / f"{cache_key}.pdf"
+        if not config["pipeline"].get("force_reprocess", False) and cache_path.exists():
+            saved_pdf_path = link_or_copy(cache_path, data_manager.pdf_dir / f"{input_stem}.pdf")
+            state_manager.save_success(
+                input_data=context.input_data,
+                input_type=context.metadata.get("input_type") or config["pipeline"].get("input_type"),
+                id=context.metadata["id"],
+                pdf_path=saved_pdf_path
+            )
+            context.set_result(self.name, saved_pdf_path)
+            logger.info(f"Reused cached PDF for id {context.metadata['id']:03d} at {saved_pdf_path}")
+            return context
         # Save LaTeX to a temp file for compilation
-        data_manager = DataManager(config)
         tex_path = data_manager.save_temp(context.metadata["id"], "latex", "tex", latex_content)
+        # Make sure any deferred image writes are on disk before latexmk runs
+        data_manager.flush()
         # Compile LaTeX to PDF as before
         output_dir = Path(config["pipeline"]["output_dir"]).resolve() / "doc"  # temp/intermediate only
         pdf_path = output_dir / f"{context.metadata['id']:03d}_notes.pdf"
-        pdf_content = self._compile_latex(tex_path, output_dir, pdf_path)
-        # Save final PDF only in canonical pdf_dir
-        # saved_pdf_path = data_manager.save_pdf(context.metadata["id"], config["pipeline"]["input_type"], pdf_content)
-        input_stem = Path(context.input_data).stem
-        saved_pdf_path = data_manager.save_pdf(input_stem, pdf_content)
+        build_dir = data_manager.cache_dir / "latexmk" / f"{context.metadata['id']:03d}"
+        compiled_pdf = self._compile_latex(tex_path, output_dir, pdf_path, build_dir)
+        # Populate the cache from the compiled PDF (hardlink, no byte copy)
+        # so the next run of identical LaTeX skips latexmk entirely.
+        try:
+            link_or_copy(compiled_pdf, cache_path)
+        except OSError as cache_err:
+            logger.debug(f"Could not cache PDF: {cache_err}")
+        # Save final PDF only in canonical pdf_dir; the compiled file is moved
+        # into place rather than read into memory and rewritten.
+        saved_pdf_path = data_manager.save_pdf(input_stem, compiled_pdf)
         state_manager.save_success(
             input_data=context.input_data,
-            input_type=config["pipeline"]["input_type"],
+            input_type=context.metadata.get("input_type") or config["pipeline"].get("input_type"),
             id=context.metadata["id"],
             pdf_path=saved_pdf_path
         )
@@ -1,8 +1,11 @@
 from abc import ABC, abstractmethod
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional, Tuple
+import concurrent.futures
 import logging
+import queue
+import threading
 import time
-from src.manager import StateManager
+from src.manager import DataManager, StateManager
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -13,6 +16,7 @@ class PipelineContext:
         self.results = {}
         self.errors = []
         self.metadata = {}
+        self.data_manager = None  # Shared DataManager, set by the pipeline runner
 
     def set_result(self, step_name: str, result: Any):
         self.results[step_name] = result
@@ -40,16 +44,33 @@ class Pipeline:
         self.state_manager = state_manager
         self.continue_on_error = continue_on_error if continue_on_error is not None else config["pipeline"].get("continue_on_error", False)
         self.failed_step = None
+        # True while _run_batch_parallel's pool is live: run() then leaves
+        # the shared failed_step attribute alone and the failure travels on
+        # the context instead.
+        self._parallel_batch = False
+        self.data_manager = DataManager(config)
 
     def run(self, input_data: Any, context: PipelineContext = None) -> PipelineContext:
-        input_type = self.config["pipeline"]["input_type"]
         if context is None:
             context = PipelineContext(input_data)
-        context.metadata["id"] = self.state_manager.get_index(input_data, input_type)  # Global unique ID
+        # input_type travels on the context; the config value is only a
+        # fallback for callers that never set it, so the shared config is
+        # never mutated per file.
+        input_type = context.metadata.get("input_type") or self.config["pipeline"].get("input_type")
+        if context.data_manager is None:
+            context.data_manager = self.data_manager
+        context.metadata.setdefault("id", self.state_manager.get_index(input_data, input_type))  # Global unique ID
         context.metadata["input_type"] = input_type
         total_start_time = time.time()
 
         for i, step in enumerate(self.steps, start=1):
+            # A result already on the context (wave pre-pass, resumed
+            # snapshot) wins over the DB lookup: tasks rows are keyed by id
+            # and INSERT OR REPLACE lets a later step's save clobber an
+            # earlier step's row, so the DB alone can't prove a step ran.
+            if context.get_result(step.name) and not self.config["pipeline"].get("force_reprocess", False):
+                logger.info(f"STEP {i}/{len(self.steps)}: {step.name} skipped (result already on context)")
+                continue
             step_output = self.state_manager.get_step_output(input_data, input_type, context.metadata["id"], step.name)
             if step_output and not self.config["pipeline"].get("force_reprocess", False):
                 logger.info(f"STEP {i}/{len(self.steps)}: {step.name} skipped (output exists at [{step_output}])")
@@ -69,8 +90,14 @@ class Pipeline:
                     )
                 end_time = time.time()
                 logger.info(f"Step {i}/{len(self.steps)}: {step.name} done in [{end_time - start_time:.2f} seconds]")
+                try:
+                    context.data_manager.save_context(context.metadata["id"], context)
+                except Exception as snapshot_err:  # Snapshot is best-effort; never fail the step
+                    logger.debug(f"Could not snapshot context: {snapshot_err}")
             except Exception as e:
-                self.failed_step = step.name
+                context.metadata["failed_step"] = step.name
+                if not self._parallel_batch:
+                    self.failed_step = step.name
                 context.add_error(step.name, e)
                 self.state_manager.log_error(context.input_data, input_type, context.metadata["id"], step.name, str(e))
                 if self.continue_on_error:
@@ -85,11 +112,23 @@ class Pipeline:
     def run_batch(self, inputs: List[Any]) -> List[PipelineContext]:
         results = []
         total_start_time = time.time()
-        input_type = self.config["pipeline"]["input_type"]
+        input_type = self.config["pipeline"].get("input_type")
+        workers = self.config["pipeline"].get("workers", 1)
+        if workers > 1 and len(inputs) > 1:
+            return self._run_batch_parallel(inputs, input_type, workers, total_start_time)
+        wave_contexts = {}
+        if len(inputs) > 1 and not self.config["pipeline"].get("force_reprocess", False):
+            # Transcription wave: submit every input's job before waiting on
+            # any, so batch transcription time is the longest job, not the
+            # sum. The waved contexts are carried into the per-input runs
+            # below, which skip the stages whose results they already hold.
+            # Pointless under force_reprocess, where each run redoes the
+            # step regardless.
+            wave_contexts = self._transcribe_wave(inputs, input_type)
         for i, input_data in enumerate(inputs, 1):
             try:
                 logger.info(f"###### Processing input {i}/{len(inputs)}: {input_data} ######")
-                context = self.run(input_data)
+                context = self.run(input_data, wave_contexts.get(input_data))
                 results.append(context)
             except Exception as e:
                 self.failed_step = "Batch"
@@ -102,5 +141,178 @@ class Pipeline:
         logger.info(f"Total batch runtime: {total_end_time - total_start_time:.2f} seconds")
         return results
 
+    def _transcribe_wave(self, inputs: List[Any], input_type: str) -> Dict[Any, PipelineContext]:
+        """Pre-run the stages up to transcription and batch-submit the rest.
+
+        Each input is walked through the steps ahead of TranscribeStep (with
+        the usual state-DB skip), then all contexts still needing a
+        transcript go through TranscribeStep.process_many, whose shared poll
+        loop waits on every job at once. Returns the waved contexts keyed by
+        input so the serial pass can resume from the in-memory results —
+        the tasks DB can't carry the hand-off, since its REPLACE-by-id
+        upsert keeps only one step's row per task. Failures here are only
+        logged; the serial pass surfaces them through the normal error path.
+        """
+        idx = next((i for i, s in enumerate(self.steps) if s.name == "TranscribeStep"), None)
+        if idx is None:
+            return
+        transcribe = self.steps[idx]
+        ready = []
+        for input_data in inputs:
+            context = PipelineContext(input_data)
+            context.data_manager = self.data_manager
+            context.metadata["id"] = self.state_manager.get_index(input_data, input_type)
+            context.metadata["input_type"] = input_type
+            try:
+                if self.state_manager.get_step_output(input_data, input_type, context.metadata["id"], transcribe.name):
+                    continue  # Transcript already on record
+                for step in self.steps[:idx]:
+                    step_output = self.state_manager.get_step_output(input_data, input_type, context.metadata["id"], step.name)
+                    if step_output:
+                        context.set_result(step.name, step_output)
+                        continue
+                    context = step.process(context, self.config, self.state_manager)
+                    if context.get_result(step.name):
+                        self.state_manager.save_step_output(
+                            input_data, input_type, context.metadata["id"],
+                            step.name, context.get_result(step.name))
+                ready.append(context)
+            except Exception as e:
+                logger.warning(f"Transcription wave skipping {input_data}: {e}")
+        if ready:
+            logger.info(f"Submitting {len(ready)} transcription jobs as one wave")
+            transcribe.process_many(ready, self.config, self.state_manager)
+        return {c.input_data: c for c in ready}
+
+    def _run_batch_parallel(self, inputs: List[Any], input_type: str, workers: int,
+                            total_start_time: float) -> List[PipelineContext]:
+        """Run batch inputs concurrently on a thread pool.
+
+        Each input's download, transcription wait, and latexmk compile is
+        I/O- or subprocess-bound, so threads overlap them well; StateManager
+        serialises its own writes behind a lock.
+        """
+        results = []
+        failures = []
+        self._parallel_batch = True
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(inputs))) as executor:
+                # Each future gets its own context so the failure handler can
+                # read the real task id run() assigned (it exists before any
+                # step can fail) instead of logging a bogus id-0 row.
+                futures = {}
+                for input_data in inputs:
+                    context = PipelineContext(input_data)
+                    futures[executor.submit(self.run, input_data, context)] = (input_data, context)
+                for future in concurrent.futures.as_completed(futures):
+                    input_data, context = futures[future]
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        logger.error(f"Failed to process input {input_data}: {str(e)}")
+                        self.state_manager.log_error(input_data, input_type, context.metadata.get("id", 0), "Batch", str(e))
+                        failures.append(e)
+        finally:
+            self._parallel_batch = False
+        # Failure state is collected per future and applied once after the
+        # pool drains, rather than each worker racing on the shared attribute.
+        if failures:
+            self.failed_step = "Batch"
+            if not self.continue_on_error:
+                raise failures[0]
+        logger.info(f"Total batch runtime: {time.time() - total_start_time:.2f} seconds")
+        return results
+
     def get_failed_step(self) -> str:
-        return self.failed_step
\ No newline at end of file
+        return self.failed_step
+
+# Sentinel telling a stage worker to shut down.
+_STAGE_DONE = object()
+
+class StagedPipeline:
+    """Overlapped producer/consumer batch runner: queue-connected workers per step.
+
+    While TranscribeStep is busy with file N, DownloadStep is already pulling
+    file N+1, so steady-state batch throughput approaches 1/max(stage_time)
+    instead of sum(stage_time). Slow stages can be widened (several workers)
+    via stage_widths, e.g. {"TranscribeStep": 4}.
+    """
+
+    def __init__(self, steps: List[ProcessingStep], config: Dict, state_manager: StateManager,
+                 stage_widths: Optional[Dict[str, int]] = None):
+        self.steps = steps
+        self.config = config
+        self.state_manager = state_manager
+        self.stage_widths = stage_widths or {}
+        self.data_manager = DataManager(config)
+        # One input queue per stage, plus a final queue collecting finished contexts.
+        self.queues: List[queue.Queue] = [queue.Queue() for _ in range(len(steps) + 1)]
+        self.threads: List[threading.Thread] = []
+
+    def _stage_worker(self, stage_idx: int) -> None:
+        step = self.steps[stage_idx]
+        in_q, out_q = self.queues[stage_idx], self.queues[stage_idx + 1]
+        while True:
+            context = in_q.get()
+            if context is _STAGE_DONE:
+                break
+            if context.metadata.get("failed_step"):
+                out_q.put(context)  # Already failed upstream; just pass it along
+                continue
+            # input_type is captured on the context at submit time; the
+            # config value is only a fallback for callers that never set it,
+            # and the shared config is never mutated per file.
+            input_type = context.metadata["input_type"]
+            try:
+                step_output = self.state_manager.get_step_output(
+                    context.input_data, input_type, context.metadata["id"], step.name)
+                if step_output and not self.config["pipeline"].get("force_reprocess", False):
+                    logger.info(f"{step.name} skipped for id {context.metadata['id']:03d} (output exists at [{step_output}])")
+                    context.set_result(step.name, step_output)
+                    out_q.put(context)
+                    continue
+                start_time = time.time()
+                context = step.process(context, self.config, self.state_manager)
+                if context.get_result(step.name):
+                    self.state_manager.save_step_output(
+                        context.input_data, input_type, context.metadata["id"],
+                        step.name, context.get_result(step.name))
+                logger.info(f"{step.name} done for id {context.metadata['id']:03d} in [{time.time() - start_time:.2f} seconds]")
+                try:
+                    context.data_manager.save_context(context.metadata["id"], context)
+                except Exception as snapshot_err:
+                    logger.debug(f"Could not snapshot context: {snapshot_err}")
+            except Exception as e:
+                context.add_error(step.name, e)
+                context.metadata["failed_step"] = step.name
+                self.state_manager.log_error(context.input_data, input_type, context.metadata["id"], step.name, str(e))
+            out_q.put(context)
+
+    def submit(self, context: PipelineContext, entry_step: Optional[str] = None) -> None:
+        """Enqueue a context, entering the chain at entry_step (default: first stage)."""
+        entry_idx = 0
+        if entry_step is not None:
+            entry_idx = next(i for i, s in enumerate(self.steps) if s.name == entry_step)
+        context.metadata.setdefault("input_type", self.config["pipeline"].get("input_type"))
+        if context.data_manager is None:
+            context.data_manager = self.data_manager
+        self.queues[entry_idx].put(context)
+
+    def run(self, submissions: List[Tuple[PipelineContext, Optional[str]]]) -> List[PipelineContext]:
+        """Process all submissions through the stage chain and return finished contexts."""
+        total_start_time = time.time()
+        for i, step in enumerate(self.steps):
+            for _ in range(self.stage_widths.get(step.name, 1)):
+                t = threading.Thread(target=self._stage_worker, args=(i,), daemon=True)
+                t.start()
+                self.threads.append(t)
+        for context, entry_step in submissions:
+            self.submit(context, entry_step)
+        results = [self.queues[-1].get() for _ in submissions]
+        for i, step in enumerate(self.steps):
+            for _ in range(self.stage_widths.get(step.name, 1)):
+                self.queues[i].put(_STAGE_DONE)
+        for t in self.threads:
+            t.join()
+        logger.info(f"Total staged batch runtime: {time.time() - total_start_time:.2f} seconds")
+        return results
\ No newline at end of file
@@ -1,8 +1,11 @@
 import logging
+import re
 import requests
 import os
+import subprocess
 import time
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter, Retry
 from src.pipeline import ProcessingStep, PipelineContext
 from src.manager import DataManager, StateManager
 from typing import Dict
@@ -10,9 +13,172 @@ from typing import Dict
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# One keep-alive session for every AssemblyAI call: the upload, the submit,
+# and each poll reuse a warm TLS connection instead of handshaking per
+# request. Transient failures retry at the transport layer with backoff.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                       max_retries=Retry(total=3, backoff_factor=0.5)))
+
+# Sniffs the status field out of a poll response without decoding the whole
+# body — completed payloads carry the full multi-MB transcript, and paying a
+# JSON parse of that per in-progress tick adds up. AssemblyAI serialises
+# status near the top, ahead of the text field; on a miss or a terminal
+# status the caller still does the real response.json().
+_STATUS_RE = re.compile(rb'"status"\s*:\s*"(\w+)"')
+
+def _poll_status(response) -> str:
+    m = _STATUS_RE.search(response.content)
+    return m.group(1).decode("ascii") if m else ""
+
+def _file_chunks(path: str, chunk_size: int = 5 * 1024 * 1024):
+    """Yield a file's bytes in chunks for a streaming upload body."""
+    with open(path, "rb") as f:
+        yield from iter(lambda: f.read(chunk_size), b"")
+
 class TranscribeStep(ProcessingStep):
+    def _upload_audio(self, audio_path: str, headers: Dict, stream_source: str = None) -> str:
+        """Upload audio to AssemblyAI and return the upload URL.
+
+        When stream_source is set (a local video file), pipe ffmpeg's extracted
+        audio directly into the upload request instead of reading a temp MP3 —
+        one pass over the bytes, no intermediate file.
+        """
+        if stream_source:
+            cmd = [
+                "ffmpeg", "-i", stream_source,
+                "-vn", "-acodec", "mp3", "-f", "mp3", "-",
+            ]
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=1 << 20)
+            try:
+                response = _SESSION.post(
+                    "https://api.assemblyai.com/v2/upload",
+                    headers=headers,
+                    data=proc.stdout
+                )
+            finally:
+                proc.stdout.close()
+                returncode = proc.wait()
+            if returncode != 0:
+                raise RuntimeError(f"ffmpeg exited with code {returncode} while streaming {stream_source}")
+        else:
+            # AssemblyAI's upload endpoint takes the raw bytes; streaming them
+            # directly skips multipart framing and keeps memory at one chunk.
+            response = _SESSION.post(
+                "https://api.assemblyai.com/v2/upload",
+                headers=headers,
+                data=_file_chunks(audio_path)
+            )
+        response.raise_for_status()
+        return response.json()["upload_url"]
+
+    def _submit_job(self, audio_path: str, headers: Dict, stream_source: str = None) -> str:
+        """Upload the audio and submit a transcription job; returns its id.
+
+        Decoupled from polling so a batch can submit every job before
+        waiting on any — AssemblyAI transcribes submissions concurrently
+        server-side.
+        """
+        start_time = time.time()
+        logger.info(f"Starting audio upload for {audio_path}")
+        upload_url = self._upload_audio(audio_path, headers, stream_source)
+        logger.info(f"Audio upload completed in {time.time() - start_time:.2f} seconds")
+        logger.info(f"Submitting transcription job for {audio_path}")
+        response = _SESSION.post(
+            "https://api.assemblyai.com/v2/transcript",
+            headers=headers,
+            json={"audio_url": upload_url}
+        )
+        response.raise_for_status()
+        return response.json()["id"]
+
+    def _save_transcript(self, context: PipelineContext, config: Dict, state_manager: StateManager,
+                         transcript_text: str) -> None:
+        """Record a finished transcript on the context, disk, and state DB."""
+        data_manager = context.data_manager or DataManager(config)
+        index = context.metadata["id"]
+        input_type = context.metadata.get("input_type") or config["pipeline"].get("input_type")
+        context.set_result(self.name, transcript_text)
+        output_path = data_manager.save_temp(index, "transcript", "txt", transcript_text)
+        state_manager.save_step_output(
+            input_data=context.input_data,
+            input_type=input_type,
+            id=index,
+            step_name=self.name,
+            output_path=output_path
+        )
+        logger.info(f"Transcribed audio to {output_path}")
+
+    def process_many(self, contexts, config: Dict, state_manager: StateManager):
+        """Transcribe a batch as one wave: submit all jobs, then share a poll loop.
+
+        Serial processing waits out each transcription before submitting the
+        next; submitting everything up front lets the server work on all of
+        them at once, so batch wall time approaches the longest job instead
+        of the sum. Failures are recorded per context, mirroring
+        NotesStep.process_many.
+        """
+        api_key = os.getenv("ASSEMBLYAI_API_KEY")
+        if not api_key:
+            raise ValueError("ASSEMBLYAI_API_KEY not found in environment variables")
+        headers = {"authorization": api_key}
+        pending: Dict[str, PipelineContext] = {}
+        for context in contexts:
+            input_type = context.metadata.get("input_type") or config["pipeline"].get("input_type")
+            try:
+                audio_path = context.get_result("DownloadStep")
+                if not audio_path or not os.path.exists(str(audio_path)):
+                    raise FileNotFoundError(f"No audio file available for {self.name} at {audio_path}")
+                job_id = self._submit_job(audio_path, headers, context.metadata.get("stream_audio_source"))
+                pending[job_id] = context
+            except Exception as e:
+                logger.error(f"Failed to submit {context.input_data}: {str(e)}")
+                context.add_error(self.name, e)
+                state_manager.log_error(context.input_data, input_type, context.metadata.get("id", 0), self.name, str(e))
+        poll_count = 0
+        poll_failures: Dict[str, int] = {}
+        while pending:
+            poll_count += 1
+            for job_id, context in list(pending.items()):
+                # A transient failure on one status GET must not abort the
+                # whole wave — other jobs may already be done server-side.
+                # Retry the job next tick; give up on it after 5 in a row.
+                try:
+                    response = _SESSION.get(
+                        f"https://api.assemblyai.com/v2/transcript/{job_id}",
+                        headers=headers
+                    )
+                    response.raise_for_status()
+                except requests.exceptions.RequestException as e:
+                    poll_failures[job_id] = poll_failures.get(job_id, 0) + 1
+                    if poll_failures[job_id] < 5:
+                        logger.warning(f"Status poll for job {job_id} failed ({e}); will retry")
+                        continue
+                    input_type = context.metadata.get("input_type") or config["pipeline"].get("input_type")
+                    logger.error(f"Giving up polling job {job_id} for {context.input_data}: {e}")
+                    context.add_error(self.name, e)
+                    state_manager.log_error(context.input_data, input_type, context.metadata.get("id", 0), self.name, str(e))
+                    del pending[job_id]
+                    continue
+                poll_failures.pop(job_id, None)
+                if _poll_status(response) in ("queued", "processing"):
+                    continue
+                transcript_data = response.json()
+                if transcript_data["status"] == "completed":
+                    self._save_transcript(context, config, state_manager, transcript_data["text"])
+                    del pending[job_id]
+                elif transcript_data["status"] == "error":
+                    input_type = context.metadata.get("input_type") or config["pipeline"].get("input_type")
+                    error = RuntimeError(f"Transcription failed: {transcript_data['error']}")
+                    logger.error(f"Failed to transcribe {context.input_data}: {error}")
+                    context.add_error(self.name, error)
+                    state_manager.log_error(context.input_data, input_type, context.metadata.get("id", 0), self.name, str(error))
+                    del pending[job_id]
+            if pending:
+                time.sleep(min(30.0, 2.0 * (1.5 ** (poll_count - 1))))
+        return contexts
+
     def process(self, context: PipelineContext, config: Dict, state_manager: StateManager) -> PipelineContext:
-        data_manager = DataManager(config)
         # Load audio file path from context, not temp file
         audio_path = context.get_result("DownloadStep")
         if not audio_path:
@@ -25,6 +191,7 @@ class TranscribeStep(ProcessingStep):
             context.set_result(self.name, None)
             raise FileNotFoundError(f"Audio file does not exist for {self.name} at {audio_path}")
         index = context.metadata["id"]
+        input_type = context.metadata.get("input_type") or config["pipeline"].get("input_type")
 
         api_key = os.getenv("ASSEMBLYAI_API_KEY")
         if not api_key:
@@ -32,63 +199,33 @@ class TranscribeStep(ProcessingStep):
 
         headers = {"authorization": api_key}
         try:
-            # Log upload start
-            start_time = time.time()
-            logger.info(f"Starting audio upload for {audio_path}")
-            with open(audio_path, "rb") as f:
-                response = requests.post(
-                    "https://api.assemblyai.com/v2/upload",
-                    headers=headers,
-                    files={"file": f}
-                )
-            response.raise_for_status()
-            upload_url = response.json()["upload_url"]
-            logger.info(f"Audio upload completed in {time.time() - start_time:.2f} seconds")
-
-            # Log transcription request
-            logger.info(f"Submitting transcription job for {audio_path}")
-            response = requests.post(
-                "https://api.assemblyai.com/v2/transcript",
-                headers=headers,
-                json={"audio_url": upload_url}
-            )
-            response.raise_for_status()
-            transcript_id = response.json()["id"]
+            transcript_id = self._submit_job(audio_path, headers, context.metadata.get("stream_audio_source"))
 
             # Log polling start
             poll_start = time.time()
             poll_count = 0
             while True:
                 poll_count += 1
-                response = requests.get(
+                response = _SESSION.get(
                     f"https://api.assemblyai.com/v2/transcript/{transcript_id}",
                     headers=headers
                 )
                 response.raise_for_status()
-                transcript_data = response.json()
-                if transcript_data["status"] == "completed":
-                    logger.info(f"Transcription completed in {time.time() - poll_start:.2f} seconds after {poll_count} polls")
-                    break
-                elif transcript_data["status"] == "error":
-                    raise RuntimeError(f"Transcription failed: {transcript_data['error']}")
-                time.sleep(5)  # Avoid excessive polling
-
-            transcript_text = transcript_data["text"]
-            # Save transcript to context
-            context.set_result(self.name, transcript_text)
-            # Optionally, save to temp file for caching/debugging
-            output_path = data_manager.save_temp(index, "transcript", "txt", transcript_text)
-            state_manager.save_step_output(
-                input_data=context.input_data,
-                input_type=config["pipeline"]["input_type"],
-                id=index,
-                step_name=self.name,
-                output_path=output_path
-            )
-            logger.info(f"Transcribed audio to {output_path}")
+                if _poll_status(response) not in ("queued", "processing"):
+                    transcript_data = response.json()
+                    if transcript_data["status"] == "completed":
+                        logger.info(f"Transcription completed in {time.time() - poll_start:.2f} seconds after {poll_count} polls")
+                        break
+                    elif transcript_data["status"] == "error":
+                        raise RuntimeError(f"Transcription failed: {transcript_data['error']}")
+                # Short videos finish fast, so poll eagerly at first and back
+                # off toward 30 s for long ones instead of a flat 5 s sleep.
+                time.sleep(min(30.0, 2.0 * (1.5 ** (poll_count - 1))))
+
+            self._save_transcript(context, config, state_manager, transcript_data["text"])
         except Exception as e:
             logger.error(f"Failed to transcribe {audio_path}: {str(e)}")
-            state_manager.log_error(context.input_data, config["pipeline"]["input_type"], index, self.name, str(e))
+            state_manager.log_error(context.input_data, input_type, index, self.name, str(e))
             raise
 
         return context
\ No newline at end of file